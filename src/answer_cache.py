@@ -0,0 +1,150 @@
+import re
+import time
+from collections import OrderedDict
+
+WORD = re.compile(r'\w+')
+
+# Words that carry no facts, ignored when comparing what two questions ask about
+STOP_WORDS = frozenset(
+    'a about after an and any are as at be before by can could did do does for from had has have how i in is it '
+    'its latest me new news of on or recent recently so tell than that the their there these this to today was '
+    'were what when where which who why will with would you'.split()
+)
+
+def normalize_prompt(prompt: str) -> str:
+    # Prompts differing only in case, punctuation or spacing ask the same question
+    return ' '.join(WORD.findall(prompt.lower()))
+
+def shingles(text: str, size: int = 4) -> frozenset:
+    # Overlapping character n-grams, so small rewordings and typos still share most of them
+    padded = f' {text} '
+    return frozenset(padded[i:i + size] for i in range(max(len(padded) - size + 1, 1)))
+
+def similarity(first: frozenset, second: frozenset) -> float:
+    # Jaccard similarity of two sets of shingles or words
+    if not first or not second:
+        return 0.0
+    return len(first & second) / len(first | second)
+
+def content_words(text: str) -> frozenset:
+    # The words of a normalized prompt that name what it asks about
+    return frozenset(word for word in text.split() if word not in STOP_WORDS)
+
+def same_facts(first: frozenset, second: frozenset, threshold: float) -> bool:
+    """
+    Whether two prompts' content words ask about the same thing: every word containing a digit must match, since
+    years, figures and versions are what tell news questions apart, and the other words must mostly overlap.
+
+    >>> first = content_words(normalize_prompt('What happened in the 2016 presidential election results?'))
+    >>> same_facts(first, content_words(normalize_prompt('What happened in the 2020 presidential election results?')), 0.8)
+    False
+    >>> same_facts(first, content_words(normalize_prompt('what happened in the 2016 presidential election results')), 0.8)
+    True
+    """
+    def numbers(words: frozenset) -> set:
+        return {word for word in words if any(character.isdigit() for character in word)}
+
+    if numbers(first) != numbers(second):
+        return False
+    return similarity(first, second) >= threshold
+
+# One cached answer and what it was built from
+class CachedAnswer:
+    def __init__(self, prompt: str, answer: str, urls: list):
+        self.prompt = prompt
+        self.shingles = shingles(prompt)
+        self.words = content_words(prompt)
+        self.answer = answer
+        self.urls = list(urls)
+        self.created = time.monotonic()
+        self.validated = self.created
+
+    @property
+    def age(self) -> float:
+        return time.monotonic() - self.created
+
+# Final answers of recent questions, kept in memory for a few minutes because news goes stale quickly
+class AnswerCache:
+    def __init__(self, ttl: float = 10 * 60, fresh_for: float = 2 * 60, max_entries: int = 256,
+                 fuzzy_threshold: float = None):
+        """
+        Args:
+            ttl (float): Seconds after which an answer is never served again.
+            fresh_for (float): Seconds an answer is served without checking its sources; older answers are
+                served only once their sources are confirmed unchanged.
+            max_entries (int): Answers kept; the least recently used are evicted first.
+            fuzzy_threshold (float): Shingle similarity at which a differently worded prompt counts as the same
+                question; only identical normalized prompts match when omitted.
+        """
+        self.ttl = ttl
+        self.fresh_for = fresh_for
+        self.max_entries = max_entries
+        self.fuzzy_threshold = fuzzy_threshold
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.fuzzy_hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def evict_expired(self):
+        # Entries are in use order, not age order, so every entry is checked
+        for key in [key for key, entry in self.entries.items() if entry.age >= self.ttl]:
+            del self.entries[key]
+
+    def get(self, prompt: str) -> CachedAnswer:
+        self.evict_expired()
+        key = normalize_prompt(prompt)
+        entry = self.entries.get(key)
+        if entry is None and self.fuzzy_threshold is not None:
+            # The most similar recent prompt, if it is similar enough and asks about the same facts; shingles alone
+            # would match questions that differ only in a year or a name
+            prompt_shingles = shingles(key)
+            prompt_words = content_words(key)
+            candidates = [(similarity(prompt_shingles, candidate.shingles), candidate_key, candidate)
+                          for candidate_key, candidate in self.entries.items()
+                          if same_facts(prompt_words, candidate.words, self.fuzzy_threshold)]
+            best = max(candidates, key=lambda candidate: candidate[0], default=None)
+            if best is not None and best[0] >= self.fuzzy_threshold:
+                _, key, entry = best
+                self.fuzzy_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def needs_validation(self, entry: CachedAnswer) -> bool:
+        return time.monotonic() - entry.validated >= self.fresh_for
+
+    def mark_validated(self, entry: CachedAnswer):
+        # Sources confirmed unchanged make the answer fresh again, though never past its ttl
+        entry.validated = time.monotonic()
+
+    def set(self, prompt: str, answer: str, urls: list):
+        key = normalize_prompt(prompt)
+        self.entries[key] = CachedAnswer(key, answer, urls)
+        self.entries.move_to_end(key)
+        self.evict_expired()
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+
+    def discard(self, entry: CachedAnswer):
+        # Drop an answer whose sources changed, unless it was already replaced by a newer one
+        self.invalidated += 1
+        if self.entries.get(entry.prompt) is entry:
+            del self.entries[entry.prompt]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'entries': len(self.entries),
+            'hits': self.hits,
+            'fuzzy_hits': self.fuzzy_hits,
+            'misses': self.misses,
+            'invalidated': self.invalidated,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
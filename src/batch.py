@@ -0,0 +1,165 @@
+import argparse
+import asyncio
+import json
+import os
+import time
+from news_gpt import NewsGPT
+from openai_request_handler import RequestScheduler
+from endpoints import add_endpoint_arguments, apply_endpoint_arguments
+from tracing import Trace, JsonLinesExporter
+
+def read_items(path: str):
+    # Yield (id, prompt, error) for each non-empty line, read lazily so the input can be any size
+    with open(path, encoding='utf-8') as file:
+        for line_number, line in enumerate(file, 1):
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+            except json.JSONDecodeError as error:
+                yield line_number, None, f'Invalid JSON: {error}'
+                continue
+            # A line is either an object with a prompt and an optional id, or just the prompt as a string
+            if isinstance(item, str):
+                yield line_number, item, None
+            elif isinstance(item, dict) and isinstance(item.get('prompt'), str):
+                yield item.get('id', line_number), item['prompt'], None
+            else:
+                yield line_number, None, 'Expected a string or an object with a "prompt" string.'
+
+def compact_checkpoint(path: str) -> set:
+    """
+    Rewrites an earlier run's output so it keeps one record per input line that will not be redone.
+
+    Answers and the errors of invalid input lines are kept; failed prompts are dropped because they are retried, and a
+    line cut short by an interruption is dropped too. The output therefore never holds two records for one id.
+
+    Args:
+        path (str): JSON lines file written by an earlier run.
+
+    Returns:
+        set: The ids, as strings, whose records were kept and are skipped by this run.
+    """
+    kept = set()
+    if not os.path.exists(path):
+        return kept
+    # Written beside the output and swapped in, so an interruption here leaves the old checkpoint intact
+    compacted_path = f'{path}.compacting'
+    with open(path, encoding='utf-8') as file, open(compacted_path, 'w', encoding='utf-8') as compacted:
+        for line in file:
+            try:
+                result = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if not isinstance(result, dict) or 'id' not in result or str(result['id']) in kept:
+                continue
+            # A record without a prompt is an invalid input line, which would only fail the same way again
+            if result.get('error') is None or result.get('prompt') is None:
+                kept.add(str(result['id']))
+                compacted.write(json.dumps(result) + '\n')
+    os.replace(compacted_path, path)
+    return kept
+
+async def answer_item(news_gpt: NewsGPT, item_id, prompt: str, timeout: float = None, bypass_cache: bool = False) -> dict:
+    # Answer one prompt and describe the outcome, failures included, as one output record
+    trace = Trace(prompt=prompt, id=item_id)
+    result = {'id': item_id, 'prompt': prompt, 'answer': None, 'error': None}
+    started = time.perf_counter()
+    try:
+        response = await asyncio.wait_for(news_gpt.get_response(prompt, bypass_cache, trace), timeout)
+        result['answer'] = response['choices'][0]['message']['content']
+    except asyncio.TimeoutError:
+        result['error'] = f'Timed out after {timeout} seconds.'
+    except Exception as error:
+        result['error'] = f'{type(error).__name__}: {error}'
+    result['elapsed'] = round(time.perf_counter() - started, 3)
+    result['stages'] = {name: round(duration, 3) for name, duration in trace.stage_durations().items()
+                        if name in ('query', 'search', 'scrape_and_summarize', 'answer')}
+    result['tokens'] = sum(usage['total_tokens'] for usage in trace.usage.values())
+    result['cost'] = round(trace.cost, 6)
+    return result
+
+async def run_batch(news_gpt: NewsGPT, input_path: str, output_path: str, concurrency: int = 8,
+                    timeout: float = None, resume: bool = True, bypass_cache: bool = False) -> dict:
+    """
+    Answers every prompt of a JSON lines file, writing one result line per prompt as soon as it is done.
+
+    Args:
+        news_gpt (NewsGPT): Shared instance, so every prompt reuses the same connections, caches and rate limits.
+        input_path (str): JSON lines file of prompts, each a string or an object with "prompt" and an optional "id".
+        output_path (str): JSON lines file results are appended to; it doubles as the checkpoint.
+        concurrency (int): Prompts answered at the same time.
+        timeout (float): Seconds allowed per prompt; no limit when omitted.
+        resume (bool): Whether prompts already answered in output_path are skipped. Failed prompts are retried and
+            their earlier records removed.
+        bypass_cache (bool): Whether cached search results and pages are ignored.
+
+    Returns:
+        dict: Counts of answered, failed and skipped prompts, the elapsed time and the throughput.
+    """
+    completed = compact_checkpoint(output_path) if resume else set()
+    items = read_items(input_path)
+    stats = {'answered': 0, 'failed': 0, 'skipped': 0}
+    started = time.perf_counter()
+
+    with open(output_path, 'a' if resume else 'w', encoding='utf-8') as output:
+        def write(result: dict):
+            # Flushed per line, so an interrupted run loses at most the prompts still in flight
+            output.write(json.dumps(result) + '\n')
+            output.flush()
+            stats['answered' if result['error'] is None else 'failed'] += 1
+
+        async def worker():
+            # Workers share one lazy iterator, so at most `concurrency` prompts are read ahead
+            for item_id, prompt, error in items:
+                if str(item_id) in completed:
+                    stats['skipped'] += 1
+                elif error is not None:
+                    write({'id': item_id, 'prompt': None, 'answer': None, 'error': error})
+                else:
+                    write(await answer_item(news_gpt, item_id, prompt, timeout, bypass_cache))
+
+        await asyncio.gather(*(worker() for _ in range(concurrency)))
+
+    stats['elapsed'] = round(time.perf_counter() - started, 3)
+    stats['throughput'] = round((stats['answered'] + stats['failed']) / stats['elapsed'], 3) if stats['elapsed'] else 0.0
+    return stats
+
+def parse_rate_limit(value: str) -> tuple:
+    # MODEL=REQUESTS_PER_MINUTE,TOKENS_PER_MINUTE, for example gpt-3.5-turbo=10000,1000000
+    try:
+        model, limits = value.split('=', 1)
+        requests_per_minute, tokens_per_minute = (float(limit) for limit in limits.split(','))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'Expected MODEL=REQUESTS_PER_MINUTE,TOKENS_PER_MINUTE, got {value!r}.')
+    return model, (requests_per_minute, tokens_per_minute)
+
+async def run(args) -> dict:
+    trace_exporter = JsonLinesExporter(args.trace_file) if args.trace_file else None
+    # Throughput is bounded by the API quota, so the scheduler is told the account's real limits
+    scheduler = RequestScheduler(dict(args.rate_limit), max_concurrency=args.api_concurrency)
+    async with NewsGPT(trace_exporter=trace_exporter, scheduler=scheduler) as news_gpt:
+        return await run_batch(news_gpt, args.input, args.output, args.concurrency, args.timeout,
+                               not args.no_resume, args.bypass_cache)
+
+def main():
+    parser = argparse.ArgumentParser(description='Answer a JSON lines file of prompts with NewsGPT.')
+    parser.add_argument('input', help='JSON lines file of prompts: strings, or objects with "prompt" and an optional "id".')
+    parser.add_argument('output', help='JSON lines file results are appended to; rerunning skips prompts already answered.')
+    parser.add_argument('--concurrency', type=int, default=8, help='Prompts answered at the same time.')
+    parser.add_argument('--api-concurrency', type=int, default=8, help='OpenAI requests in flight at the same time.')
+    parser.add_argument('--rate-limit', type=parse_rate_limit, action='append', default=[], metavar='MODEL=RPM,TPM',
+                        help='Requests and tokens per minute allowed for a model; repeat for several models.')
+    parser.add_argument('--timeout', type=float, help='Seconds allowed per prompt.')
+    parser.add_argument('--no-resume', action='store_true', help='Overwrite the output instead of skipping answered prompts.')
+    parser.add_argument('--bypass-cache', action='store_true', help='Ignore cached search results and pages.')
+    add_endpoint_arguments(parser)
+    parser.add_argument('--trace-file', help='Append the trace of every prompt to this JSON lines file.')
+    args = parser.parse_args()
+
+    apply_endpoint_arguments(args)
+
+    print(json.dumps(asyncio.run(run(args))))
+
+if __name__ == '__main__':
+    main()
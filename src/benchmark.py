@@ -0,0 +1,189 @@
+import argparse
+import asyncio
+import json
+import math
+import time
+from news_gpt import NewsGPT
+from openai_request_handler import RequestScheduler, DEFAULT_RATE_LIMITS
+from fake_upstreams import FakeUpstreams, UpstreamProfile
+from domain_health import DomainHealth
+
+# Stages timed one after another, each fed by the results of the previous one, followed by the whole pipeline
+STAGES = ('query', 'search', 'scrape', 'summarize', 'answer', 'get_response')
+
+def percentile(values: list, percent: float) -> float:
+    # Nearest-rank percentile of the values, or 0 when there are none
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[max(math.ceil(percent / 100 * len(ordered)) - 1, 0)]
+
+# Latencies and failures of one stage
+class StageResult:
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies = []
+        self.failures = 0
+        self.wall_time = 0.0
+
+    def summary(self) -> dict:
+        return {
+            'count': len(self.latencies),
+            'failures': self.failures,
+            'p50': percentile(self.latencies, 50),
+            'p95': percentile(self.latencies, 95),
+            'p99': percentile(self.latencies, 99),
+            'throughput': len(self.latencies) / self.wall_time if self.wall_time else 0.0,
+        }
+
+async def run_stage(name: str, inputs: list, function, concurrency: int) -> tuple:
+    """
+    Runs function on every input with bounded concurrency and times each call.
+
+    Args:
+        name (str): Stage name used in the report.
+        inputs (list): Arguments for each call; None entries come from failed earlier stages and are skipped.
+        function: Coroutine function called with one input.
+        concurrency (int): Calls allowed to run at the same time.
+
+    Returns:
+        tuple: The StageResult and a list of outputs aligned with inputs, None where the call failed.
+    """
+    result = StageResult(name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed(argument):
+        if argument is None:
+            return None
+        async with semaphore:
+            started = time.perf_counter()
+            try:
+                output = await function(argument)
+            except Exception:
+                result.failures += 1
+                return None
+            result.latencies.append(time.perf_counter() - started)
+            return output
+
+    started = time.perf_counter()
+    outputs = await asyncio.gather(*(timed(argument) for argument in inputs))
+    result.wall_time = time.perf_counter() - started
+    return result, outputs
+
+async def benchmark(news_gpt: NewsGPT, questions: list, concurrency: int) -> list:
+    # Caches are bypassed throughout so every run measures the cold path
+    results = []
+
+    async def search(query):
+        return await news_gpt.google_searcher.perform_search(query, bypass_cache=True)
+
+    async def scrape(urls):
+        return await news_gpt.web_scraper.extract_texts_from_websites(urls, bypass_cache=True)
+
+    async def summarize(item):
+        question, texts = item
+        plan = news_gpt.plan_summaries(question, texts)
+        return await news_gpt.summarize_chunks(plan.chunks, question, plan.summary_tokens, bypass_cache=True)
+
+    async def answer(item):
+        question, search_data = item
+        return await news_gpt.get_response_with_search_data(question, search_data)
+
+    async def get_response(question):
+        return await news_gpt.get_response(question, bypass_cache=True)
+
+    result, queries = await run_stage('query', questions, news_gpt.generate_search_query, concurrency)
+    results.append(result)
+    result, urls = await run_stage('search', queries, search, concurrency)
+    results.append(result)
+    result, texts = await run_stage('scrape', urls, scrape, concurrency)
+    results.append(result)
+    result, summaries = await run_stage('summarize', [
+        (question, text) if text is not None else None for question, text in zip(questions, texts)
+    ], summarize, concurrency)
+    results.append(result)
+    result, _ = await run_stage('answer', [
+        (question, summary) if summary is not None else None for question, summary in zip(questions, summaries)
+    ], answer, concurrency)
+    results.append(result)
+
+    # Fresh questions so the end-to-end run cannot share in-flight work with the staged run
+    result, _ = await run_stage('get_response', [f'{question} (end to end)' for question in questions],
+                                get_response, concurrency)
+    results.append(result)
+    return results
+
+def format_report(results: list, upstreams: FakeUpstreams) -> str:
+    lines = [f"{'stage':<14}{'count':>7}{'failed':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'ops/s':>10}"]
+    for result in results:
+        summary = result.summary()
+        lines.append(
+            f"{result.name:<14}{summary['count']:>7}{summary['failures']:>8}"
+            f"{summary['p50'] * 1000:>10.1f}{summary['p95'] * 1000:>10.1f}{summary['p99'] * 1000:>10.1f}"
+            f"{summary['throughput']:>10.2f}"
+        )
+    lines.append(f"upstream requests: {upstreams.requests}, injected errors: {upstreams.injected_errors}")
+    return '\n'.join(lines)
+
+async def run(args) -> dict:
+    upstreams = FakeUpstreams(
+        chat=UpstreamProfile(args.chat_latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after),
+        search=UpstreamProfile(args.search_latency, args.jitter, args.error_rate, args.rate_limit_rate, args.retry_after),
+        pages=UpstreamProfile(args.page_latency, args.jitter, args.error_rate, 0.0, args.retry_after,
+                              args.page_tail_rate, args.page_tail_latency),
+        page_count=args.page_count,
+        page_bytes=args.page_bytes,
+        results_per_search=args.results_per_search,
+        completion_words=args.completion_words,
+        seed=args.seed,
+    )
+    async with upstreams:
+        upstreams.install()
+        # Without --rate-limits the client-side limits are lifted so the pipeline itself is measured
+        rate_limits = None if args.rate_limits else {model: (10 ** 9, 10 ** 12) for model in DEFAULT_RATE_LIMITS}
+        scheduler = RequestScheduler(rate_limits, max_concurrency=args.api_concurrency)
+        # Every stand-in page is served from one host, so the per-host limit and skip list would treat them as one site
+        domain_health = DomainHealth(per_host_limit=10 ** 6, failure_threshold=10 ** 6)
+        questions = [f'What is the latest news about topic {index}?' for index in range(args.questions)]
+        async with NewsGPT('benchmark-key', 'benchmark-key', 'benchmark-cx', use_cache=False,
+                           scheduler=scheduler, parse_backend=args.parse_backend, domain_health=domain_health,
+                           hedged_fetches=not args.no_hedging) as news_gpt:
+            results = await benchmark(news_gpt, questions, args.concurrency)
+
+        print(format_report(results, upstreams))
+        report = {result.name: result.summary() for result in results}
+        report['upstream'] = {'requests': upstreams.requests, 'injected_errors': upstreams.injected_errors}
+        return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark NewsGPT offline against local stand-in upstreams.')
+    parser.add_argument('--questions', type=int, default=20)
+    parser.add_argument('--concurrency', type=int, default=4, help='Questions processed at the same time.')
+    parser.add_argument('--api-concurrency', type=int, default=8, help='OpenAI requests in flight at the same time.')
+    parser.add_argument('--chat-latency', type=float, default=0.2)
+    parser.add_argument('--search-latency', type=float, default=0.1)
+    parser.add_argument('--page-latency', type=float, default=0.1)
+    parser.add_argument('--jitter', type=float, default=0.05)
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--rate-limit-rate', type=float, default=0.0, help='Fraction of OpenAI and search requests answered with 429.')
+    parser.add_argument('--retry-after', type=float, default=0.1)
+    parser.add_argument('--page-tail-rate', type=float, default=0.0, help='Fraction of page requests that are slow.')
+    parser.add_argument('--page-tail-latency', type=float, default=2.0, help='Extra seconds a slow page request takes.')
+    parser.add_argument('--no-hedging', action='store_true', help='Do not race slow pages with spare search results.')
+    parser.add_argument('--page-count', type=int, default=50)
+    parser.add_argument('--page-bytes', type=int, default=50000)
+    parser.add_argument('--results-per-search', type=int, default=10)
+    parser.add_argument('--completion-words', type=int, default=120)
+    parser.add_argument('--parse-backend', default='inline', choices=('inline', 'thread', 'process'))
+    parser.add_argument('--rate-limits', action='store_true', help='Apply the default client-side rate limits.')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--json', help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
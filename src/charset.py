@@ -0,0 +1,82 @@
+import codecs
+import re
+from collections import Counter
+import chardet
+
+# Byte order marks, longest first so UTF-32 is not mistaken for UTF-16
+BOMS = [
+    (codecs.BOM_UTF32_LE, 'utf-32'),
+    (codecs.BOM_UTF32_BE, 'utf-32'),
+    (codecs.BOM_UTF8, 'utf-8-sig'),
+    (codecs.BOM_UTF16_LE, 'utf-16'),
+    (codecs.BOM_UTF16_BE, 'utf-16'),
+]
+
+# Only the start of a document is searched for a <meta charset> or http-equiv declaration
+META_SCAN_SIZE = 4096
+
+# Upper bound on the bytes handed to chardet when nothing was declared
+DETECT_SAMPLE_SIZE = 16384
+
+DEFAULT_ENCODING = 'utf-8'
+
+# Matches both <meta charset="..."> and <meta http-equiv="Content-Type" content="...; charset=...">
+META_CHARSET = re.compile(rb'<meta[^>]*?charset\s*=\s*["\']?\s*([\w.:-]+)', re.IGNORECASE)
+
+# How often each resolution path was taken: header, bom, meta, detected or default
+resolution_counts = Counter()
+
+def lookup_encoding(name) -> str:
+    # Return the canonical codec name, or None when Python does not know the encoding
+    if not name:
+        return None
+    if isinstance(name, bytes):
+        name = name.decode('ascii', 'ignore')
+    try:
+        return codecs.lookup(name.strip()).name
+    except LookupError:
+        return None
+
+def resolve_encoding(header_charset: str, sample: bytes) -> tuple:
+    """
+    Resolves the encoding of a document from the cheapest reliable source available.
+
+    Args:
+        header_charset (str): The charset declared in the Content-Type header, if any.
+        sample (bytes): The first bytes of the document.
+
+    Returns:
+        tuple: The codec name and the path that produced it.
+    """
+    encoding, source = _resolve(header_charset, sample)
+    resolution_counts[source] += 1
+    return encoding, source
+
+def _resolve(header_charset: str, sample: bytes) -> tuple:
+    encoding = lookup_encoding(header_charset)
+    if encoding:
+        return encoding, 'header'
+
+    for bom, name in BOMS:
+        if sample.startswith(bom):
+            return name, 'bom'
+
+    match = META_CHARSET.search(sample[:META_SCAN_SIZE])
+    encoding = lookup_encoding(match.group(1)) if match else None
+    if encoding:
+        return encoding, 'meta'
+
+    # Fall back to statistical detection on a bounded sample only
+    encoding = lookup_encoding(chardet.detect(sample[:DETECT_SAMPLE_SIZE])['encoding']) if sample else None
+    # A sample of pure ASCII markup says nothing about the text further down, and UTF-8 decodes ASCII unchanged
+    if encoding == 'ascii':
+        return DEFAULT_ENCODING, 'detected'
+    if encoding:
+        return encoding, 'detected'
+
+    return DEFAULT_ENCODING, 'default'
+
+def get_resolution_stats() -> dict:
+    # Share of documents resolved by each path, to measure how often detection is avoided
+    total = sum(resolution_counts.values())
+    return {source: count / total for source, count in resolution_counts.items()} if total else {}
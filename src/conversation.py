@@ -0,0 +1,59 @@
+from token_budget import count_message_tokens, truncate_tokens
+
+# The turns of one chat session that follow-up questions are answered with, bounded by a token budget
+class Conversation:
+    # How the running summary of turns that left the window is shown to the model
+    SUMMARY_MESSAGE = 'Summary of the earlier conversation: {summary}'
+
+    def __init__(self, max_tokens: int = 2000, max_answer_tokens: int = 600, model: str = 'gpt-3.5-turbo-16k'):
+        """
+        Args:
+            max_tokens (int): Tokens the summary and the recent turns may take in a request together.
+            max_answer_tokens (int): Longest stored answer; longer answers are kept truncated.
+            model (str): Model whose tokenizer measures the window.
+        """
+        self.max_tokens = max_tokens
+        self.max_answer_tokens = max_answer_tokens
+        self.model = model
+        # Recent turns as (question, answer) pairs, oldest first
+        self.turns = []
+        # Running summary of every turn that left the window, and turns waiting to be folded into it
+        self.summary = ''
+        self.evicted = []
+        # Task folding evicted turns into the summary, awaited before the conversation is used again
+        self.compaction = None
+
+    def __len__(self):
+        return len(self.turns)
+
+    def messages(self) -> list:
+        # Fresh message dicts every call, so requests built from them never share state with the conversation
+        messages = []
+        if self.summary:
+            messages.append({'role': 'system', 'content': self.SUMMARY_MESSAGE.format(summary=self.summary)})
+        for question, answer in self.turns:
+            messages.append({'role': 'user', 'content': question})
+            messages.append({'role': 'assistant', 'content': answer})
+        return messages
+
+    def tokens(self) -> int:
+        return count_message_tokens(self.messages(), self.model) if self.turns or self.summary else 0
+
+    def add_turn(self, question: str, answer: str):
+        # Slide the window: the oldest turns leave it until the rest fit, but the latest turn always stays
+        self.turns.append((question, truncate_tokens(answer, self.max_answer_tokens, self.model)))
+        while len(self.turns) > 1 and self.tokens() > self.max_tokens:
+            self.evicted.append(self.turns.pop(0))
+
+    def take_evicted(self) -> list:
+        evicted, self.evicted = self.evicted, []
+        return evicted
+
+    def clear(self):
+        # Start a new session; a compaction still running would only fill in the summary being discarded
+        if self.compaction is not None:
+            self.compaction.cancel()
+            self.compaction = None
+        self.turns = []
+        self.summary = ''
+        self.evicted = []
@@ -1,19 +1,120 @@
 import asyncio
 import aiohttp
 import os
-from dotenv import load_dotenv
 import time
-from exceptions import GoogleApiError
+from urllib.parse import urlencode, urlsplit, urlunsplit, parse_qsl
+from exceptions import GoogleApiError, SearchQuotaExceeded
+from http_client import HttpClient
+from disk_cache import DiskCache
+from single_flight import SingleFlight
+from tracing import span, record_cache, record_count
+
+def normalize_query(query: str) -> str:
+    # Queries differing only in case, quoting or spacing return the same results
+    return ' '.join(query.replace('"', '').lower().split())
+
+# Query parameters that only track where a click came from and never change the page
+TRACKING_PARAMETERS = frozenset(('fbclid', 'gclid', 'dclid', 'msclkid', 'mc_cid', 'mc_eid', 'igshid', 'ref', 'ref_src'))
+
+def canonicalize_url(url: str) -> str:
+    # A key under which the same page reached through different links compares equal; the link itself is still fetched
+    parts = urlsplit(url.strip())
+    host = (parts.hostname or '').lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    if parts.port is not None and parts.port not in (80, 443):
+        host = f'{host}:{parts.port}'
+    query = sorted(
+        (name, value) for name, value in parse_qsl(parts.query, keep_blank_values=True)
+        if not name.lower().startswith('utm_') and name.lower() not in TRACKING_PARAMETERS
+    )
+    path = parts.path.rstrip('/') or '/'
+    # http and https, default ports, fragments and parameter order never change which article is served
+    return urlunsplit(('', host, path, urlencode(query), ''))
+
+# Limits how many Custom Search API calls one question may spend; results served from the cache are free
+class SearchQuota:
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.used = 0
+        self.denied = 0
+
+    @property
+    def remaining(self) -> int:
+        return max(self.limit - self.used, 0)
+
+    def acquire(self) -> bool:
+        # Spend one call, or report that the budget is gone
+        if self.used >= self.limit:
+            self.denied += 1
+            return False
+        self.used += 1
+        return True
 
 # A class for performing Google searches using the Custom Search JSON API
 class GoogleSearcher:
-    def __init__(self, api_key, cx):
+    SEARCH_URL = 'https://www.googleapis.com/customsearch/v1'
+
+    # How long cached results stay valid; short because news goes stale quickly
+    CACHE_TTL = 15 * 60
+
+    # Results per Custom Search page, the most the API returns for one call
+    PAGE_SIZE = 10
+
+    # Damping of the rank fusion score: higher values weigh how often a URL appears over how high it ranks
+    RANK_FUSION_K = 60
+
+    def __init__(self, api_key, cx, http_client: HttpClient = None, cache: DiskCache = None, cache_ttl: float = CACHE_TTL):
         self.api_key = api_key
         self.cx = cx
+        self.http_client = http_client if http_client is not None else HttpClient()
+        # Optional persistent cache of results, keyed on the normalized query and the search engine ID
+        self.cache = cache
+        self.cache_ttl = cache_ttl
+        # Identical searches running at the same time share one API call
+        self.single_flight = SingleFlight()
+
+    def cache_key(self, query: str, start: int = 1) -> str:
+        # The first page keeps the original key so results cached before pagination stay valid
+        key = f'{self.cx}\n{normalize_query(query)}'
+        return key if start == 1 else f'{key}\n{start}'
 
-    async def search_google(self, session, query: str):
-        search_url = f"https://www.googleapis.com/customsearch/v1?q={query}&key={self.api_key}&cx={self.cx}"
-        return await self.fetch(session, search_url)
+    async def search_google(self, session, query: str, bypass_cache: bool = False, start: int = 1,
+                            quota: SearchQuota = None):
+        # Serve repeated queries from the cache to save quota and a round trip
+        use_cache = self.cache is not None and not bypass_cache
+        if use_cache:
+            result = self.cache.get(self.cache_key(query, start), max_age=self.cache_ttl)
+            record_cache('search', result is not None)
+            if result is not None:
+                return result
+
+        def start_request():
+            # Only a call that starts a new request spends quota; one joining an identical search in flight does not
+            if quota is not None and not quota.acquire():
+                raise SearchQuotaExceeded()
+            return self.fetch_results(session, query, start)
+
+        # Concurrent misses for the same normalized query and page wait on the first one's request
+        with span('search_request', start=start):
+            try:
+                return await self.single_flight.run(self.cache_key(query, start), start_request)
+            except SearchQuotaExceeded:
+                # A question whose search budget is spent gets no more results rather than an error
+                record_count('search_quota_denied')
+                return {'items': []}
+
+    async def fetch_results(self, session, query: str, start: int = 1):
+        parameters = {'q': query, 'key': self.api_key, 'cx': self.cx}
+        if start > 1:
+            parameters['start'] = start
+        result = await self.fetch(session, f"{self.SEARCH_URL}?{urlencode(parameters)}")
+
+        # Only the links are used, so only the links are stored
+        result = {'items': [{'link': item['link']} for item in result.get('items', [])]}
+        if self.cache is not None:
+            self.cache.set(self.cache_key(query, start), result)
+        return result
 
     async def fetch(self, session, url):
         headers = {
@@ -32,8 +133,55 @@ class GoogleSearcher:
         except Exception as e:
             raise GoogleApiError(f"Unexpected error: {str(e)}")
     
-    async def perform_search(self, query: str):
-        async with aiohttp.ClientSession() as session:
-            result = await self.search_google(session, query)
-            return [item['link'] for item in result['items']]
+    async def perform_search(self, query: str, bypass_cache: bool = False):
+        session = await self.http_client.get_session()
+        result = await self.search_google(session, query, bypass_cache)
+        return [item['link'] for item in result['items']]
+
+    async def perform_searches(self, queries: list, pages: int = 1, bypass_cache: bool = False,
+                               quota: SearchQuota = None, max_results: int = None) -> list:
+        """
+        Runs several query variants at once and merges their results.
+
+        Args:
+            queries (list): Search queries; variants that normalize to the same query are searched once.
+            pages (int): Result pages fetched per query through the API's start parameter.
+            bypass_cache (bool): Whether cached results are ignored.
+            quota (SearchQuota): API calls this question may still spend; first pages of every query are served first.
+            max_results (int): Maximum number of links returned; all of them when omitted.
+
+        Returns:
+            list: Links with duplicates removed, ranked by how often and how high each one appeared.
+        """
+        session = await self.http_client.get_session()
+        queries = list({normalize_query(query): query for query in queries if query.strip()}.values())
+        # Every query's first page is requested before any second page, so a tight quota still covers every variant
+        requests = [(query, page * self.PAGE_SIZE + 1) for page in range(pages) for query in queries]
+        results = await asyncio.gather(*(
+            self.search_google(session, query, bypass_cache, start, quota) for query, start in requests
+        ), return_exceptions=True)
+
+        # A failed variant only costs its results; the search fails only when every request did
+        errors = [result for result in results if isinstance(result, BaseException)]
+        if errors and len(errors) == len(results):
+            raise errors[0]
+        for error in errors:
+            if not isinstance(error, Exception):
+                raise error
+
+        # Reciprocal rank fusion: each appearance adds more the higher it ranked, and the first link seen is kept
+        scores = {}
+        links = {}
+        for (query, start), result in zip(requests, results):
+            if isinstance(result, BaseException):
+                continue
+            for position, item in enumerate(result['items']):
+                key = canonicalize_url(item['link'])
+                links.setdefault(key, item['link'])
+                scores[key] = scores.get(key, 0.0) + 1 / (self.RANK_FUSION_K + start + position)
+        record_count('search_results', sum(len(result['items']) for result in results if not isinstance(result, BaseException)))
+        record_count('search_unique_results', len(links))
+
+        ranked = sorted(links, key=lambda key: -scores[key])
+        return [links[key] for key in ranked[:max_results]]
         
\ No newline at end of file
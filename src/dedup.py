@@ -0,0 +1,86 @@
+import hashlib
+import re
+import numpy as np
+from html_text import BLANK_LINES
+
+WORD = re.compile(r'\w+')
+
+# Bit positions of a 64-bit fingerprint
+BITS = np.arange(64, dtype=np.uint64)
+
+def simhash(text: str, shingle_size: int = 3) -> int:
+    # 64-bit SimHash over word shingles; near-identical texts get fingerprints a few bits apart
+    words = WORD.findall(text.lower())
+    shingles = [' '.join(words[i:i + shingle_size]) for i in range(max(len(words) - shingle_size + 1, 1))]
+    hashes = np.array([
+        int.from_bytes(hashlib.blake2b(shingle.encode('utf-8'), digest_size=8).digest(), 'little') for shingle in shingles
+    ], dtype=np.uint64)
+    # Every shingle votes on every bit; the majority decides the fingerprint
+    votes = ((hashes[:, None] >> BITS) & np.uint64(1)).sum(axis=0, dtype=np.int64) * 2 - len(hashes)
+    return sum(1 << int(bit) for bit in np.flatnonzero(votes > 0))
+
+# Drops paragraphs that nearly repeat one already seen, keeping the first copy as the representative
+class ParagraphDeduplicator:
+    def __init__(self, max_distance: int = 6, min_chars: int = 80, bands: int = 8):
+        """
+        Args:
+            max_distance (int): Largest number of differing fingerprint bits still treated as a duplicate.
+            min_chars (int): Paragraphs shorter than this are always kept; they are too short to fingerprint reliably.
+            bands (int): Fingerprint slices used to find candidates; must exceed max_distance so no duplicate is missed.
+        """
+        self.max_distance = max_distance
+        self.min_chars = min_chars
+        self.bands = bands
+        self.band_bits = 64 // bands
+        # Fingerprints seen so far, bucketed by the value of each band
+        self.buckets = [{} for _ in range(bands)]
+
+        # Counters for reporting how much text was removed
+        self.paragraphs = 0
+        self.removed_paragraphs = 0
+        self.total_chars = 0
+        self.removed_chars = 0
+
+    def band_values(self, fingerprint: int) -> list:
+        mask = (1 << self.band_bits) - 1
+        return [(fingerprint >> (band * self.band_bits)) & mask for band in range(self.bands)]
+
+    def is_duplicate(self, fingerprint: int) -> bool:
+        # Two fingerprints within max_distance bits agree on at least one band, so only those buckets are checked
+        bands = self.band_values(fingerprint)
+        for band, value in enumerate(bands):
+            for seen in self.buckets[band].get(value, ()):
+                if (seen ^ fingerprint).bit_count() <= self.max_distance:
+                    return True
+        for band, value in enumerate(bands):
+            self.buckets[band].setdefault(value, []).append(fingerprint)
+        return False
+
+    def filter(self, text: str) -> str:
+        # Return the text without paragraphs that near-duplicate earlier ones, from this or any earlier text
+        kept = []
+        for paragraph in text.split('\n'):
+            stripped = paragraph.strip()
+            self.total_chars += len(paragraph)
+            if len(stripped) >= self.min_chars:
+                self.paragraphs += 1
+                if self.is_duplicate(simhash(stripped)):
+                    self.removed_paragraphs += 1
+                    self.removed_chars += len(paragraph)
+                    continue
+            kept.append(paragraph)
+        return BLANK_LINES.sub('\n\n', '\n'.join(kept)).strip()
+
+    def stats(self) -> dict:
+        return {
+            'paragraphs': self.paragraphs,
+            'removed_paragraphs': self.removed_paragraphs,
+            'total_chars': self.total_chars,
+            'removed_chars': self.removed_chars,
+            'removed_rate': self.removed_chars / self.total_chars if self.total_chars else 0.0,
+        }
+
+def deduplicate_texts(texts: list) -> tuple:
+    # Deduplicate a list of page texts in order, returning the filtered texts and the deduplicator's report
+    deduplicator = ParagraphDeduplicator()
+    return [deduplicator.filter(text) for text in texts], deduplicator.stats()
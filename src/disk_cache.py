@@ -0,0 +1,117 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+
+def default_cache_dir() -> str:
+    # Caches live under NEWSGPT_CACHE_DIR, or the user's cache directory by default
+    return os.getenv('NEWSGPT_CACHE_DIR') or os.path.join(os.path.expanduser('~'), '.cache', 'newsgpt')
+
+# A small persistent key-value cache backed by SQLite, with age checks and size-bounded LRU eviction
+class DiskCache:
+    def __init__(self, path: str, max_entries: int = None, max_bytes: int = None):
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        # Counters for measuring how much work the cache saves
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        # One connection shared across threads, guarded by a lock
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS entries ('
+            'key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, '
+            'stored_at REAL NOT NULL, accessed_at REAL NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)')
+
+    def get_entry(self, key: str):
+        # Return the stored value and the time it was stored, or None, and count the lookup
+        with self._lock:
+            row = self._connection.execute('SELECT value, stored_at FROM entries WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self._connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (time.time(), key))
+            self.hits += 1
+            return json.loads(row[0]), row[1]
+
+    def get(self, key: str, max_age: float = None):
+        # Return the value if present and younger than max_age seconds; stale entries count as misses
+        with self._lock:
+            row = self._connection.execute('SELECT value, stored_at FROM entries WHERE key = ?', (key,)).fetchone()
+            now = time.time()
+            if row is None or (max_age is not None and now - row[1] > max_age):
+                if row is not None:
+                    self._connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+                self.misses += 1
+                return None
+            self._connection.execute('UPDATE entries SET accessed_at = ? WHERE key = ?', (now, key))
+            self.hits += 1
+            return json.loads(row[0])
+
+    def set(self, key: str, value):
+        data = json.dumps(value)
+        now = time.time()
+        with self._lock:
+            self._connection.execute(
+                'INSERT OR REPLACE INTO entries (key, value, size, stored_at, accessed_at) VALUES (?, ?, ?, ?, ?)',
+                (key, data, len(data), now, now)
+            )
+            self._evict()
+
+    def touch(self, key: str):
+        # Mark an entry as freshly stored, for example after the origin confirmed it is unchanged
+        now = time.time()
+        with self._lock:
+            self._connection.execute('UPDATE entries SET stored_at = ?, accessed_at = ? WHERE key = ?', (now, now, key))
+
+    def delete(self, key: str):
+        with self._lock:
+            self._connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+
+    def clear(self):
+        with self._lock:
+            self._connection.execute('DELETE FROM entries')
+
+    def _evict(self):
+        # Drop least recently used entries until both the entry and byte limits hold
+        count, total = self._connection.execute('SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries').fetchone()
+        excess_entries = count - self.max_entries if self.max_entries is not None else 0
+        excess_bytes = total - self.max_bytes if self.max_bytes is not None else 0
+        if excess_entries <= 0 and excess_bytes <= 0:
+            return
+        victims = []
+        for key, size in self._connection.execute('SELECT key, size FROM entries ORDER BY accessed_at'):
+            if excess_entries <= 0 and excess_bytes <= 0:
+                break
+            victims.append((key,))
+            excess_entries -= 1
+            excess_bytes -= size
+        self._connection.executemany('DELETE FROM entries WHERE key = ?', victims)
+        self.evictions += len(victims)
+
+    def __len__(self):
+        with self._lock:
+            return self._connection.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
@@ -0,0 +1,133 @@
+import asyncio
+import time
+from collections import OrderedDict
+from urllib.parse import urlsplit
+
+def domain_of(url: str) -> str:
+    return (urlsplit(url).hostname or '').lower()
+
+# Latency and failure history of one website, kept across questions
+class DomainStats:
+    def __init__(self):
+        # Smoothed fetch time and its mean deviation, estimated like a TCP retransmission timer
+        self.latency = None
+        self.deviation = 0.0
+        # Doubles with every timeout in a row so a slow site gets more time on its next try
+        self.backoff = 1.0
+        self.successes = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.skip_until = 0.0
+        self.skips = 0
+        self.limiter = None
+
+    def to_dict(self, now: float) -> dict:
+        return {
+            'latency': self.latency,
+            'deviation': self.deviation,
+            'successes': self.successes,
+            'failures': self.failures,
+            'consecutive_failures': self.consecutive_failures,
+            'skips': self.skips,
+            'skipped_for': max(self.skip_until - now, 0.0),
+        }
+
+# Per-domain statistics that set each site's timeout, concurrency and hedge delay, and skip sites that keep failing
+class DomainHealth:
+    def __init__(self,
+        default_timeout: float = 3,
+        min_timeout: float = 1,
+        max_timeout: float = 8,
+        hedge_delay: float = 1,
+        per_host_limit: int = 4,
+        failure_threshold: int = 3,
+        skip_seconds: float = 5 * 60,
+        max_skip_seconds: float = 60 * 60,
+        max_domains: int = 10000
+    ):
+        """
+        Args:
+            default_timeout (float): Seconds allowed for a page from a site without history.
+            min_timeout (float): Shortest timeout, however fast a site has been.
+            max_timeout (float): Longest timeout, however slow a site has been.
+            hedge_delay (float): Seconds before a spare page is fetched for a slow site without history.
+            per_host_limit (int): Page downloads allowed in flight to one site at a time.
+            failure_threshold (int): Failures in a row after which a site is skipped.
+            skip_seconds (float): How long a site is skipped at first; doubles with each further failure.
+            max_skip_seconds (float): Longest time a site is skipped.
+            max_domains (int): Sites remembered; the least recently used are forgotten first.
+        """
+        self.default_timeout = default_timeout
+        self.min_timeout = min_timeout
+        self.max_timeout = max_timeout
+        self.hedge_delay = hedge_delay
+        self.per_host_limit = per_host_limit
+        self.failure_threshold = failure_threshold
+        self.skip_seconds = skip_seconds
+        self.max_skip_seconds = max_skip_seconds
+        self.max_domains = max_domains
+        self.domains = OrderedDict()
+
+    def get(self, domain: str) -> DomainStats:
+        stats = self.domains.get(domain)
+        if stats is None:
+            stats = self.domains[domain] = DomainStats()
+            if len(self.domains) > self.max_domains:
+                self.domains.popitem(last=False)
+        else:
+            self.domains.move_to_end(domain)
+        return stats
+
+    def timeout_for(self, domain: str) -> float:
+        # Fast sites are cut off soon after they usually finish; slow ones that do finish are given the time they need
+        stats = self.get(domain)
+        if stats.latency is None:
+            timeout = self.default_timeout
+        else:
+            timeout = stats.latency + 4 * stats.deviation
+        return min(max(timeout * stats.backoff, self.min_timeout), self.max_timeout)
+
+    def hedge_delay_for(self, domain: str) -> float:
+        # A fetch running well past the site's usual time is likely stuck in the tail
+        stats = self.get(domain)
+        if stats.latency is None:
+            return min(self.hedge_delay, self.timeout_for(domain))
+        return min(stats.latency + 2 * stats.deviation, self.timeout_for(domain))
+
+    def is_skipped(self, domain: str) -> bool:
+        return self.get(domain).skip_until > time.monotonic()
+
+    def limiter(self, domain: str) -> asyncio.Semaphore:
+        # Bounds the downloads from one site, so a burst of links to it does not queue behind its own slowness
+        stats = self.get(domain)
+        if stats.limiter is None:
+            stats.limiter = asyncio.Semaphore(self.per_host_limit)
+        return stats.limiter
+
+    def record_success(self, domain: str, elapsed: float):
+        stats = self.get(domain)
+        if stats.latency is None:
+            stats.latency = elapsed
+            stats.deviation = elapsed / 2
+        else:
+            stats.deviation += (abs(elapsed - stats.latency) - stats.deviation) / 4
+            stats.latency += (elapsed - stats.latency) / 8
+        stats.backoff = 1.0
+        stats.successes += 1
+        stats.consecutive_failures = 0
+
+    def record_failure(self, domain: str, timed_out: bool = False):
+        stats = self.get(domain)
+        stats.failures += 1
+        stats.consecutive_failures += 1
+        if timed_out:
+            stats.backoff = min(stats.backoff * 2, self.max_timeout / self.min_timeout)
+        # Past the threshold the site is skipped, longer with every failure of the trial fetch that follows
+        excess = stats.consecutive_failures - self.failure_threshold
+        if excess >= 0:
+            stats.skip_until = time.monotonic() + min(self.skip_seconds * 2 ** excess, self.max_skip_seconds)
+            stats.skips += 1
+
+    def snapshot(self) -> dict:
+        now = time.monotonic()
+        return {domain: stats.to_dict(now) for domain, stats in self.domains.items()}
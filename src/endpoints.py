@@ -0,0 +1,18 @@
+import argparse
+import os
+from openai_request_handler import APIBase
+from data_fetcher import GoogleSearcher
+
+def add_endpoint_arguments(parser: argparse.ArgumentParser):
+    # Command line options, defaulting to the environment, that point NewsGPT at other API hosts
+    parser.add_argument('--openai-base-url', default=os.getenv('OPENAI_BASE_URL'),
+                        help='Override the OpenAI API base URL, for example to point at a local stand-in.')
+    parser.add_argument('--search-url', default=os.getenv('GOOGLE_SEARCH_URL'),
+                        help='Override the Custom Search endpoint, for example to point at a local stand-in.')
+
+def apply_endpoint_arguments(args: argparse.Namespace):
+    # Applied to the classes, so every client created afterwards uses the overridden hosts
+    if args.openai_base_url:
+        APIBase.BASE_URL = args.openai_base_url.rstrip('/')
+    if args.search_url:
+        GoogleSearcher.SEARCH_URL = args.search_url
@@ -8,6 +8,17 @@ class OpenAiApiError(Exception):
     def __init__(self, message: str = "An error occurred with OpenAI's API"):
         super().__init__(message)
 
+class RetryableApiError(OpenAiApiError):
+    """Exception for OpenAI API errors that are worth retrying, such as rate limits and server errors."""
+    def __init__(self, message: str = "A retryable error occurred with OpenAI's API", retry_after: float = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class SearchQuotaExceeded(GoogleApiError):
+    """Exception for a search that would exceed the question's search quota."""
+    def __init__(self, message: str = "The search quota for this question is spent"):
+        super().__init__(message)
+
 class HttpsError(Exception):
     """Custom exception for HTTPS request errors."""
     def __init__(self, message: str = "An error occured with the Https request"):
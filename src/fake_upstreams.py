@@ -0,0 +1,192 @@
+import asyncio
+import hashlib
+import json
+import random
+import re
+from aiohttp import web
+from openai_request_handler import APIBase
+from data_fetcher import GoogleSearcher
+
+# Latency and failure behavior of one stand-in endpoint
+class UpstreamProfile:
+    def __init__(self, latency: float = 0.05, jitter: float = 0.0, error_rate: float = 0.0,
+                 rate_limit_rate: float = 0.0, retry_after: float = 0.1, tail_rate: float = 0.0,
+                 tail_latency: float = 0.0):
+        """
+        Args:
+            latency (float): Seconds before each response starts.
+            jitter (float): Extra random delay of up to this many seconds.
+            error_rate (float): Fraction of requests answered with 500.
+            rate_limit_rate (float): Fraction of requests answered with 429.
+            retry_after (float): Seconds advertised in the retry headers of a 429.
+            tail_rate (float): Fraction of requests that are slow.
+            tail_latency (float): Extra seconds a slow request takes.
+        """
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.tail_rate = tail_rate
+        self.tail_latency = tail_latency
+
+# Words used to fill the stand-in pages with distinct paragraphs
+VOCABULARY = ('officials', 'said', 'report', 'market', 'city', 'government', 'results', 'analysts', 'expected',
+              'week', 'statement', 'growth', 'police', 'election', 'company', 'shares', 'storm', 'court',
+              'research', 'team', 'season', 'prices', 'energy', 'local', 'national', 'record', 'plan', 'vote')
+
+# Section headings of a packed summary request
+SECTION_MARKER = re.compile(r'^=== SECTION \d+ ===$', re.MULTILINE)
+# How many search queries a query-variant request asks for
+QUERY_COUNT = re.compile(r'up to (\d+)')
+
+# Local stand-ins for the OpenAI chat completions API, the Custom Search API and the websites it returns
+class FakeUpstreams:
+    def __init__(self, chat: UpstreamProfile = None, search: UpstreamProfile = None, pages: UpstreamProfile = None,
+                 page_count: int = 20, page_bytes: int = 50000, results_per_search: int = 10,
+                 completion_words: int = 120, stream_delay: float = 0.005, seed: int = None,
+                 host: str = '127.0.0.1', port: int = 0):
+        self.chat = chat if chat is not None else UpstreamProfile()
+        self.search = search if search is not None else UpstreamProfile()
+        self.pages = pages if pages is not None else UpstreamProfile()
+        self.page_count = page_count
+        self.page_bytes = page_bytes
+        self.results_per_search = results_per_search
+        self.completion_words = completion_words
+        self.stream_delay = stream_delay
+        self.random = random.Random(seed)
+        self.host = host
+        self.port = port
+        self.base_url = None
+        self._runner = None
+
+        # Requests received and failures injected, by endpoint
+        self.requests = {'chat': 0, 'search': 0, 'pages': 0}
+        self.injected_errors = {'chat': 0, 'search': 0, 'pages': 0}
+
+    async def start(self) -> str:
+        app = web.Application()
+        app.router.add_post('/v1/chat/completions', self.handle_chat)
+        app.router.add_get('/customsearch/v1', self.handle_search)
+        app.router.add_get('/pages/{page}', self.handle_page)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        site = web.TCPSite(self._runner, self.host, self.port)
+        await site.start()
+        # With port 0 the operating system picks a free port
+        self.port = self._runner.addresses[0][1]
+        self.base_url = f'http://{self.host}:{self.port}'
+        return self.base_url
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def install(self):
+        # Point every NewsGPT client at these servers instead of the real APIs
+        APIBase.BASE_URL = f'{self.base_url}/v1'
+        GoogleSearcher.SEARCH_URL = f'{self.base_url}/customsearch/v1'
+
+    async def simulate(self, name: str, profile: UpstreamProfile):
+        # Wait out the configured latency, then return an injected failure response or None
+        self.requests[name] += 1
+        delay = profile.latency + self.random.uniform(0, profile.jitter)
+        if self.random.random() < profile.tail_rate:
+            delay += profile.tail_latency
+        await asyncio.sleep(delay)
+        roll = self.random.random()
+        if roll < profile.rate_limit_rate:
+            self.injected_errors[name] += 1
+            return web.json_response({'error': {'message': 'Rate limit reached.'}}, status=429, headers={
+                'Retry-After': str(max(int(profile.retry_after), 1)),
+                'retry-after-ms': str(int(profile.retry_after * 1000)),
+            })
+        if roll < profile.rate_limit_rate + profile.error_rate:
+            self.injected_errors[name] += 1
+            return web.json_response({'error': {'message': 'Injected server error.'}}, status=500)
+        return None
+
+    def completion_text(self, messages: list) -> str:
+        # Deterministic filler whose length is set by completion_words
+        system = messages[0]['content'] if messages else ''
+        kind = 'summary' if 'summary' in system else 'answer'
+        content = messages[-1]['content'] if messages else ''
+        seed = hashlib.sha256(content.encode('utf-8')).hexdigest()[:8]
+        text = ' '.join(f'{kind}-{seed}-{i}' for i in range(self.completion_words))
+        # Packed summary requests get one marked summary per section, as the instructions ask
+        sections = len(SECTION_MARKER.findall(content)) if '### SUMMARY n ###' in system else 0
+        if sections:
+            return '\n'.join(f'### SUMMARY {number} ###\n{text}' for number in range(1, sections + 1))
+        # Requests for several search queries get that many distinct lines
+        variants = QUERY_COUNT.search(system) if 'one query per line' in system else None
+        if variants:
+            return '\n'.join(f'query-{seed}-{number}' for number in range(int(variants.group(1))))
+        return text
+
+    async def handle_chat(self, request: web.Request) -> web.StreamResponse:
+        failure = await self.simulate('chat', self.chat)
+        if failure is not None:
+            return failure
+        body = await request.json()
+        text = self.completion_text(body.get('messages', []))
+        prompt_tokens = sum(len(message['content']) // 4 for message in body.get('messages', []))
+        completion_tokens = len(text) // 4
+        usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                 'total_tokens': prompt_tokens + completion_tokens}
+        if not body.get('stream'):
+            return web.json_response({
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': text}, 'finish_reason': 'stop'}],
+                'usage': usage,
+            })
+
+        # Streamed completions send one word per server-sent event
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream'})
+        await response.prepare(request)
+        for word in text.split(' '):
+            event = {'choices': [{'index': 0, 'delta': {'content': word + ' '}}]}
+            await response.write(f'data: {json.dumps(event)}\n\n'.encode('utf-8'))
+            await asyncio.sleep(self.stream_delay)
+        # Like the real API, usage comes in a last chunk without choices when the client asks for it
+        if body.get('stream_options', {}).get('include_usage'):
+            await response.write(f"data: {json.dumps({'choices': [], 'usage': usage})}\n\n".encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        return response
+
+    async def handle_search(self, request: web.Request) -> web.Response:
+        failure = await self.simulate('search', self.search)
+        if failure is not None:
+            return failure
+        # Different queries land on different, overlapping sets of pages
+        query = request.query.get('q', '')
+        first = int(hashlib.sha256(query.encode('utf-8')).hexdigest(), 16) % self.page_count
+        start = int(request.query.get('start', 1)) - 1
+        pages = [(first + start + i) % self.page_count for i in range(min(self.results_per_search, self.page_count))]
+        return web.json_response({'items': [{'link': f'{self.base_url}/pages/{page}'} for page in pages]})
+
+    async def handle_page(self, request: web.Request) -> web.Response:
+        failure = await self.simulate('pages', self.pages)
+        if failure is not None:
+            return failure
+        page = request.match_info['page']
+        # Pages never change, so a conditional request with the page's validator is answered without a body
+        etag = f'"{page}-{self.page_bytes}"'
+        if request.headers.get('If-None-Match') == etag:
+            return web.Response(status=304, headers={'ETag': etag})
+        # Paragraphs are seeded by page and position, so every page is distinct but identical on each request
+        paragraphs = []
+        size = 0
+        while size < self.page_bytes:
+            words = random.Random(f'{page}-{len(paragraphs)}').choices(VOCABULARY, k=40)
+            paragraph = f'<p>{" ".join(words).capitalize()}.</p>\n'
+            paragraphs.append(paragraph)
+            size += len(paragraph)
+        html = f'<html><head><title>Page {page}</title></head><body>{"".join(paragraphs)}</body></html>'
+        return web.Response(text=html, content_type='text/html', headers={'ETag': etag})
@@ -1,9 +1,10 @@
 import tkinter as tk
 from tkinter import font, messagebox
-from news_gpt import NewsGPT
 import asyncio
-import threading
+import importlib
+import queue
 import time
+from loop_thread import AsyncLoopThread
 from exceptions import OpenAiApiError, GoogleApiError, HttpsError
 
 class NewsGPTGui:
@@ -22,9 +23,30 @@ class NewsGPTGui:
         # Flag to control the thinking animation
         self.animate_thinking_running = False
 
-        # Placeholder for NewsGPT object
+        # Minimum time in seconds between chat window updates while an answer is streaming in
+        self.stream_flush_interval = 0.05
+
+        # One event loop thread runs every request, so connections and caches are reused between questions
+        self.loop_thread = AsyncLoopThread()
+
+        # Updates produced on the loop thread are queued here and applied on the Tk thread
+        self.ui_queue = queue.Queue()
+        self.ui_poll_interval = 20  # Time in milliseconds between checks of the update queue
+
+        # Future of the question currently being answered, used by the Stop button
+        self.current_request = None
+
+        # Placeholder for NewsGPT object; its modules are slow to import, so they load in the background
+        # while the popup is shown
         self.news_gpt = None
 
+        # Future of the connection pool created and warmed up while the keys are entered, then handed to NewsGPT
+        self.prepare_request = None
+        self.warm_up_task = None
+
+        # Earlier questions and answers of this chat session, so follow-up questions can refer to them
+        self.conversation = None
+
         # Placeholder for API keys and search engine ID
         self.openai_api_key = None
         self.google_api_key = None
@@ -34,8 +56,11 @@ class NewsGPTGui:
         # Configure the main window and display the popup
         self.root.configure(bg=self.dark_background)
         self.root.withdraw()  # Initially hide the main chat window
+        self.root.protocol("WM_DELETE_WINDOW", self.close)
+        self.loop_thread.start()
         self.display_popup()
         self.build_chat_window()
+        self.poll_ui_queue()
         self.root.mainloop()  # Start the Tkinter event loop    
         
     def display_popup(self):
@@ -80,6 +105,22 @@ class NewsGPTGui:
         self.access_button = tk.Button(self.center_frame, text="Enter Chat", command=self.show_chat_window, bg=self.dark_background, fg=self.light_text)
         self.access_button.pack(pady=10, ipadx=10, ipady=5)  # Increase padding inside the button
 
+        # Load NewsGPT and connect to its APIs while the user is typing
+        self.prepare_request = self.loop_thread.submit(self.prepare_news_gpt())
+
+    async def prepare_news_gpt(self):
+        """
+        Imports NewsGPT on a worker thread and starts warming up DNS, TLS and the tokenizers on the loop thread.
+
+        Returns:
+            HttpClient: The connection pool being warmed up, returned as soon as it exists so the chat window can use it.
+        """
+        loop = asyncio.get_running_loop()
+        news_gpt = await loop.run_in_executor(None, importlib.import_module, 'news_gpt')
+        http_client = news_gpt.HttpClient()
+        self.warm_up_task = asyncio.create_task(news_gpt.warm_up(http_client))
+        return http_client
+
     def build_chat_window(self):
         # Set a large font for the chat window elements
         self.large_font = font.Font(size=15)  # Font size can be adjusted as needed
@@ -117,7 +158,7 @@ class NewsGPTGui:
         self.message_entry = tk.Entry(self.entry_border_frame, insertbackground='white', bd=0, 
                                       bg=self.dark_background, fg=self.light_text, font=('Arial', 20), width=30)
         self.message_entry.pack(fill='both', expand=True, padx=8)  # Filling the available space
-        self.message_entry.bind('<Return>', lambda event: self.run_async_coroutine(self.send_message()))  # Bind enter key to send message
+        self.message_entry.bind('<Return>', self.send_message)  # Bind enter key to send message
 
         # Configuring the grid to allocate more space to the message entry
         self.bottom_frame.columnconfigure(0, weight=6)
@@ -127,12 +168,18 @@ class NewsGPTGui:
 
         # Creating the send button
         self.send_button = tk.Button(self.bottom_frame, text="Send", 
-                                     command=lambda: self.run_async_coroutine(self.send_message()),
+                                     command=self.send_message,
                                      bg=self.dark_background, fg=self.light_text, font=self.button_font)
         self.send_button.grid(row=0, column=1, sticky='ew', ipady=10)
 
-        # Configuring the grid to allocate space to the send button
+        # Creating the stop button, enabled only while an answer is in progress
+        self.stop_button = tk.Button(self.bottom_frame, text="Stop", command=self.stop_request, state=tk.DISABLED,
+                                     bg=self.dark_background, fg=self.light_text, font=self.button_font)
+        self.stop_button.grid(row=0, column=2, sticky='ew', padx=(12, 0), ipady=10)
+
+        # Configuring the grid to allocate space to the send and stop buttons
         self.bottom_frame.columnconfigure(1, weight=1)
+        self.bottom_frame.columnconfigure(2, weight=1)
 
     def show_chat_window(self):
         """
@@ -151,8 +198,17 @@ class NewsGPTGui:
             self.popup.destroy()
             self.root.deiconify()
             
-            # Initialize the NewsGPT class with the entered API keys
-            self.news_gpt = NewsGPT(self.openai_api_key, self.google_api_key, self.search_engine_id)
+            # Initialize the NewsGPT class with the entered API keys and the pool warmed up in the background; the
+            # import has usually finished by now, otherwise this waits for it rather than building a second pool
+            http_client = self.prepare_request.result()
+            from news_gpt import NewsGPT, warm_up
+            from conversation import Conversation
+            self.news_gpt = NewsGPT(self.openai_api_key, self.google_api_key, self.search_engine_id,
+                                    http_client=http_client)
+            self.conversation = Conversation()
+
+            # Idle pooled connections close after a while, so warm them again for the first question
+            self.loop_thread.submit(warm_up(self.news_gpt.http_client))
 
             # Debug print statement - can be removed in production
             print(self.news_gpt)
@@ -175,7 +231,7 @@ class NewsGPTGui:
             self.error_message_label.config(text=missing_fields_message)
 
             # Automatically hide the message after a delay
-            self.popup.after(3500, lambda: self.error_message_label.config(text=""), lambda: self.run_async_coroutine(self.send_message()))
+            self.popup.after(3500, lambda: self.error_message_label.config(text=""))
 
     def animate_thinking(self, dots=1):
         """
@@ -218,7 +274,7 @@ class NewsGPTGui:
         # Schedule the next frame of the animation after a brief pause
         self.root.after(500, self.animate_thinking, next_dots)
 
-    async def send_message(self, event=None):
+    def send_message(self, event=None):
         """
         Handles the process of sending a message in a chat application. 
         """
@@ -226,11 +282,12 @@ class NewsGPTGui:
         # Get and strip the message from the message entry widget
         message = self.message_entry.get().strip()
 
-        # Check if the message is not empty
-        if message:
+        # Check if the message is not empty and no other answer is in progress
+        if message and self.current_request is None:
             # Disable the send button and unbind the Return key to prevent duplicate sends
             self.send_button.config(state=tk.DISABLED)
             self.message_entry.unbind('<Return>')
+            self.stop_button.config(state=tk.NORMAL)
 
             # Insert the user's message into the chat history
             self.chat_history.config(state=tk.NORMAL)
@@ -243,66 +300,137 @@ class NewsGPTGui:
             self.animate_thinking_running = True
             self.animate_thinking(3)
 
-            # Attempt to get a response from the news_gpt service
-            try:
-                response = await self.news_gpt.get_response(message) 
-            except (OpenAiApiError, GoogleApiError, HttpsError, Exception) as e:
-                # Handle different types of exceptions and set an appropriate response message
-                if isinstance(e, OpenAiApiError):
-                    response = f"OpenAI API error: {e}"
-                elif isinstance(e, GoogleApiError):
-                    response = f"Google API error: {e}"
-                elif isinstance(e, HttpsError):  
-                    response = f"Https error: {e}"
-                else: 
-                    response = f"Unexpected error: {e}"
-
-            # Process the response if it's in dict format
-            if isinstance(response, dict):
-                response = response['choices'][0]['message']['content']
-            
-            # Stop the "Thinking..." animation
-            self.animate_thinking_running = False
+            # Answer the question on the loop thread; the Tk thread stays free to redraw and handle Stop
+            # answer_message re-enables input itself once its last update is queued
+            self.current_request = self.loop_thread.submit(self.answer_message(message))
 
-            # Delete the "Thinking..." message from the chat history
-            self.chat_history.config(state=tk.NORMAL)
-            self.chat_history.delete("end-2l linestart", "end-1l lineend")
+    async def answer_message(self, message):
+        """
+        Streams the answer to a message on the loop thread, queueing chat window updates for the Tk thread.
 
-            # Insert the response from GPT into the chat history
-            self.chat_history.insert(tk.END, f"GPT: ", 'name_color')
-            self.chat_history.insert(tk.END, f"{response}\n\n", 'spaced_line')
+        Args:
+            message (str): The question entered by the user.
+        """
+        # Stream the response from the news_gpt service, showing text as soon as it arrives
+        response_started = False
+        pending_text = []
+        last_flush = time.monotonic()
+        try:
+            async for delta in self.news_gpt.stream_response(message, conversation=self.conversation):
+                if not response_started:
+                    self.post_to_ui(self.begin_response)
+                    response_started = True
+                # Batch deltas so the widget is updated at most once per flush interval
+                pending_text.append(delta)
+                if time.monotonic() - last_flush >= self.stream_flush_interval:
+                    self.post_to_ui(self.append_response, ''.join(pending_text))
+                    pending_text.clear()
+                    last_flush = time.monotonic()
+        except asyncio.CancelledError:
+            # Stop was pressed; cancelling this task has already cancelled the searches and summaries under it
+            pending_text.append("\nStopped." if response_started else "Stopped.")
+        except (OpenAiApiError, GoogleApiError, HttpsError, Exception) as e:
+            # Handle different types of exceptions and set an appropriate response message
+            if isinstance(e, OpenAiApiError):
+                error_message = f"OpenAI API error: {e}"
+            elif isinstance(e, GoogleApiError):
+                error_message = f"Google API error: {e}"
+            elif isinstance(e, HttpsError):  
+                error_message = f"Https error: {e}"
+            else: 
+                error_message = f"Unexpected error: {e}"
+            # Put the error on its own line if part of the answer was already shown
+            if response_started:
+                error_message = f"\n{error_message}"
+            pending_text.append(error_message)
+        finally:
+            # Show whatever is left and close the response; input is re-enabled only after these updates, so a
+            # stopped answer can never write into the next question's entry
+            if not response_started:
+                self.post_to_ui(self.begin_response)
+            self.post_to_ui(self.append_response, ''.join(pending_text) + "\n\n")
+            self.post_to_ui(self.finish_response)
+
+    def stop_request(self):
+        # Cancel the in-flight question; the cancellation reaches the pipeline on the loop thread
+        if self.current_request is not None:
+            self.stop_button.config(state=tk.DISABLED)
+            # Cancel from the loop thread, after the task has started, so answer_message always unwinds through its
+            # finally block; cancelling a task that never ran would skip it and leave input disabled
+            self.loop_thread.loop.call_soon_threadsafe(self.current_request.cancel)
+
+    def finish_response(self):
+        """
+        Re-enables message input once an answer has completed, failed or been stopped.
+        """
+        self.current_request = None
+        self.stop_button.config(state=tk.DISABLED)
 
-            # Scroll the chat history to the latest message
-            self.chat_history.see(tk.END)
-            self.chat_history.config(state=tk.DISABLED)
+        # Re-enable the send button and re-bind the Return key to send_message
+        self.send_button.config(state=tk.NORMAL)
+        self.message_entry.bind('<Return>', self.send_message)
 
-            # Re-enable the send button and re-bind the Return key to send_message
-            self.send_button.config(state=tk.NORMAL)
-            self.message_entry.bind('<Return>', lambda event: self.run_async_coroutine(self.send_message()))
+    def post_to_ui(self, function, *args):
+        # Tk widgets may only be touched from the Tk thread, so other threads queue their updates
+        self.ui_queue.put((function, args))
 
+    def poll_ui_queue(self):
+        # Apply queued updates on the Tk thread, then check again shortly
+        while True:
+            try:
+                function, args = self.ui_queue.get_nowait()
+            except queue.Empty:
+                break
+            function(*args)
+        self.root.after(self.ui_poll_interval, self.poll_ui_queue)
 
-    @staticmethod
-    def run_async_coroutine(coroutine):
+    def close(self):
+        """
+        Cancels any in-flight question, releases NewsGPT's connections and caches, and closes the window.
+        """
+        if self.current_request is not None:
+            self.current_request.cancel()
+        if self.news_gpt is not None or self.prepare_request is not None:
+            try:
+                # Before the chat window opens, the warmed-up pool belongs to no NewsGPT yet and is closed on its own
+                if self.news_gpt is not None:
+                    closing = self.news_gpt.close()
+                else:
+                    closing = self.prepare_request.result(timeout=5).close()
+                self.loop_thread.submit(closing).result(timeout=5)
+            except Exception:
+                pass
+        self.loop_thread.stop()
+        self.root.destroy()
+
+    def begin_response(self):
+        """
+        Stops the "Thinking..." animation and starts a new GPT entry in the chat history.
         """
-        Runs an asynchronous coroutine in a separate thread.
+        # Stop the "Thinking..." animation
+        self.animate_thinking_running = False
 
-        This method is a utility to run async coroutines in a GUI environment where 
-        the main thread is blocked by the GUI loop and can't be used for async operations.
+        # Delete the "Thinking..." message from the chat history
+        self.chat_history.config(state=tk.NORMAL)
+        self.chat_history.delete("end-2l linestart", "end-1l lineend")
 
-        Args:
-            coroutine: The asynchronous coroutine that needs to be run.
-        """
+        # Insert the name tag for the response from GPT
+        self.chat_history.insert(tk.END, f"GPT: ", 'name_color')
+        self.chat_history.see(tk.END)
+        self.chat_history.config(state=tk.DISABLED)
 
-        # Define a function to run the coroutine
-        def run():
-            # Create a new event loop for the coroutine
-            # This is necessary because each thread must have its own event loop
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
+    def append_response(self, text):
+        """
+        Appends streamed response text to the current GPT entry in the chat history.
 
-            # Run the coroutine to completion in the new event loop
-            loop.run_until_complete(coroutine)
+        Args:
+            text (str): The text received since the last update.
+        """
+        if not text:
+            return
+        self.chat_history.config(state=tk.NORMAL)
+        self.chat_history.insert(tk.END, text, 'spaced_line')
 
-        # Start a new thread targeting the 'run' function
-        # This allows the coroutine to run asynchronously without blocking the main thread
-        threading.Thread(target=run).start()
+        # Scroll the chat history to the latest text
+        self.chat_history.see(tk.END)
+        self.chat_history.config(state=tk.DISABLED)
@@ -0,0 +1,84 @@
+import re
+from html.parser import HTMLParser
+
+# Elements whose contents are never visible text
+SKIPPED_TAGS = {'script', 'style', 'noscript', 'template'}
+
+# Elements that start a new line of text, so words from neighbouring blocks are not glued together
+BLOCK_TAGS = {
+    'p', 'div', 'br', 'li', 'ul', 'ol', 'tr', 'td', 'th', 'table', 'section', 'article',
+    'header', 'footer', 'nav', 'aside', 'h1', 'h2', 'h3', 'h4', 'h5', 'h6', 'pre', 'blockquote', 'title',
+}
+
+# Runs of blank lines left behind by layout markup
+BLANK_LINES = re.compile(r'\n\s*\n+')
+
+# Streaming parser that collects visible text as parse events arrive
+class _TextParser(HTMLParser):
+    def __init__(self, extractor):
+        super().__init__(convert_charrefs=True)
+        self.extractor = extractor
+        self.skip_depth = 0
+
+    def handle_starttag(self, tag, attrs):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth += 1
+        elif tag in BLOCK_TAGS:
+            self.extractor.append('\n')
+
+    def handle_endtag(self, tag):
+        if tag in SKIPPED_TAGS:
+            self.skip_depth = max(self.skip_depth - 1, 0)
+        elif tag in BLOCK_TAGS:
+            self.extractor.append('\n')
+
+    def handle_data(self, data):
+        if not self.skip_depth:
+            self.extractor.append(data)
+
+# Incremental HTML to text converter that can be fed a page piece by piece and stops at a character cap
+class HtmlTextExtractor:
+    def __init__(self, max_chars: int = None):
+        self.max_chars = max_chars
+        self.chars = 0
+        self.parts = []
+        self.parser = _TextParser(self)
+
+    @property
+    def full(self) -> bool:
+        return self.max_chars is not None and self.chars >= self.max_chars
+
+    def append(self, text: str):
+        if self.full:
+            return
+        if self.max_chars is not None:
+            text = text[:self.max_chars - self.chars]
+        self.parts.append(text)
+        self.chars += len(text)
+
+    def feed(self, html: str) -> bool:
+        # Parse the next piece of the page and report whether the cap has been reached
+        if html and not self.full:
+            self.parser.feed(html)
+        return self.full
+
+    def close(self) -> str:
+        self.parser.close()
+        text = BLANK_LINES.sub('\n\n', ''.join(self.parts))
+        return text.strip()
+
+def extract_text_from_html(html: str, max_chars: int = None) -> str:
+    extractor = HtmlTextExtractor(max_chars)
+    extractor.feed(html)
+    return extractor.close()
+
+def extract_text_from_bytes(raw: bytes, encoding: str, max_chars: int = None) -> str:
+    # Decode and extract in one step so a worker process only receives bytes and returns text
+    return extract_text_from_html(raw.decode(encoding, errors='replace'), max_chars)
+
+def extract_text_with_soup(raw: bytes, encoding: str) -> str:
+    # Build a full DOM with BeautifulSoup and lxml, as the buffered scraper mode does; imported here because only
+    # that mode needs it and it is slow to load
+    from bs4 import BeautifulSoup
+    soup = BeautifulSoup(raw.decode(encoding, errors='replace'), 'lxml')
+    return soup.get_text().strip()
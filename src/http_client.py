@@ -0,0 +1,69 @@
+import asyncio
+import aiohttp
+
+# Default timeout for requests that do not pass their own
+default_timeout = aiohttp.ClientTimeout(total=30)
+
+# A long-lived, pooled HTTP transport shared by the OpenAI models, the Google searcher and the web scraper; each of
+# them creates a private one when none is injected
+class HttpClient:
+    def __init__(self,
+        limit: int = 100,
+        limit_per_host: int = 10,
+        keepalive_timeout: float = 30,
+        dns_cache_ttl: int = 300,
+        timeout: aiohttp.ClientTimeout = default_timeout
+    ):
+        # Connection pool settings used whenever a new session is created
+        self.limit = limit
+        self.limit_per_host = limit_per_host
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache_ttl = dns_cache_ttl
+        self.timeout = timeout
+
+        # The session is created lazily because it has to be bound to a running event loop
+        self._session = None
+        self._loop = None
+
+    async def get_session(self) -> aiohttp.ClientSession:
+        loop = asyncio.get_running_loop()
+        # A session belongs to the loop that created it, so a different loop needs a fresh session
+        if self._session is None or self._session.closed or self._loop is not loop:
+            connector = aiohttp.TCPConnector(
+                limit=self.limit,
+                limit_per_host=self.limit_per_host,
+                keepalive_timeout=self.keepalive_timeout,
+                ttl_dns_cache=self.dns_cache_ttl,
+                use_dns_cache=True,
+            )
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+            self._loop = loop
+        return self._session
+
+    async def prewarm(self, urls: list, timeout: float = 5):
+        # Resolve each URL's host and open a connection to it, which then waits in the pool for the first real
+        # request; the response itself does not matter, and a host that cannot be reached is simply left cold
+        session = await self.get_session()
+
+        async def connect(url: str):
+            try:
+                async with session.head(url, allow_redirects=False, timeout=aiohttp.ClientTimeout(total=timeout)):
+                    pass
+            except Exception:
+                pass
+
+        await asyncio.gather(*(connect(url) for url in urls))
+
+    async def close(self):
+        # Close the pooled connections if the session belongs to the current loop
+        session, loop = self._session, self._loop
+        self._session = None
+        self._loop = None
+        if session is not None and not session.closed and loop is asyncio.get_running_loop():
+            await session.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
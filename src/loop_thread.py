@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+# Runs one asyncio event loop on a background thread for the lifetime of the application
+class AsyncLoopThread:
+    def __init__(self, name: str = 'newsgpt-loop'):
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+
+    def start(self):
+        if not self.thread.is_alive():
+            self.thread.start()
+        return self
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        try:
+            self.loop.run_forever()
+        finally:
+            # Cancel whatever is still running so sessions and generators are closed cleanly
+            pending = asyncio.all_tasks(self.loop)
+            for task in pending:
+                task.cancel()
+            self.loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            self.loop.run_until_complete(self.loop.shutdown_asyncgens())
+            self.loop.close()
+
+    def submit(self, coroutine):
+        """
+        Schedules a coroutine on the background loop from any thread.
+
+        Args:
+            coroutine: The coroutine to run.
+
+        Returns:
+            concurrent.futures.Future: Resolves with the coroutine's result; cancelling it cancels the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+    def stop(self, timeout: float = 5):
+        # Stop the loop and wait for the thread to finish its cleanup
+        if self.thread.is_alive():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join(timeout)
@@ -1,64 +1,479 @@
-from openai_request_handler import Gpt4, ChatGpt
-from data_fetcher import GoogleSearcher
-from web_scraper import extract_text_from_websites
+from openai_request_handler import APIBase, Gpt4, ChatGpt, RequestScheduler, PRIORITY_HIGH, PRIORITY_LOW
+from data_fetcher import GoogleSearcher, SearchQuota
+from web_scraper import WebScraper
+from domain_health import DomainHealth
+from http_client import HttpClient
+from parse_executor import ParseExecutor
+from disk_cache import DiskCache, default_cache_dir
+from summary_cache import SummaryCache
+from token_budget import TokenBudgetPlanner, CONTEXT_WINDOWS, count_tokens, get_encoding, split_tokens, truncate_tokens
+from tracing import Trace, MetricsRegistry, trace_context, span, record_cache, record_count
+from relevance import RelevanceIndex
+from dedup import ParagraphDeduplicator, deduplicate_texts
+from conversation import Conversation
+from answer_cache import AnswerCache
 import os
+import re
 import asyncio
 from dotenv import load_dotenv
-from exceptions import GoogleApiError, OpenAiApiError
+from exceptions import GoogleApiError, OpenAiApiError, HttpsError
 
-load_dotenv()
+async def warm_up(http_client: HttpClient, timeout: float = 5):
+    # Resolve and connect to the OpenAI and Custom Search hosts, leaving the connections in the pool for the first
+    # question, and load the tokenizers on a worker thread; any failure just leaves the work to the first question
+    loop = asyncio.get_running_loop()
+    tokenizers = loop.run_in_executor(None, lambda: [get_encoding(model) for model in (NewsGPT.ANSWER_MODEL, NewsGPT.SUMMARY_MODEL)])
+    await asyncio.gather(http_client.prewarm([APIBase.BASE_URL, GoogleSearcher.SEARCH_URL], timeout), tokenizers,
+                         return_exceptions=True)
 
 class NewsGPT:
 
-    MAX_CHARS = 50000
+    # Models and reply lengths of the final answer and the chunk summaries
+    ANSWER_MODEL = 'gpt-3.5-turbo-16k'
+    ANSWER_MAX_TOKENS = 1000
+    SUMMARY_MODEL = 'gpt-3.5-turbo'
+    SUMMARY_MAX_TOKENS = 1000
+
+    # Upper bound on summary requests per question, however large the pages are
+    MAX_SUMMARY_CHUNKS = 12
+
+    # Search fan-out per question: query variants, result pages per variant, Custom Search calls allowed and pages kept
+    SEARCH_QUERIES = 3
+    SEARCH_PAGES = 1
+    SEARCH_QUOTA = 6
+    MAX_SOURCES = 10
+
+    # Further search results kept in reserve, fetched when a source fails, is skipped or is slow
+    SPARE_SOURCES = 4
+
+    # Final answers are served again for ANSWER_CACHE_TTL seconds, checked against their sources after ANSWER_FRESH_FOR,
+    # and with fuzzy matching on, reused for prompts at least ANSWER_FUZZY_THRESHOLD similar
+    ANSWER_CACHE_TTL = 10 * 60
+    ANSWER_FRESH_FOR = 2 * 60
+    ANSWER_FUZZY_THRESHOLD = 0.8
+
+    # Seconds from the start of scraping after which the answer is written with whatever summaries are done
+    PIPELINE_DEADLINE = 10
+
+    # System prompts for the final answer and for the chunk summaries
+    ANSWER_SYSTEM_PROMPT = 'Please use the following realtime data from the internet to aid in the answering of the prompt. Please do not remind the user that you do not have internet access. They already know. \n DATA TO HELP AID RESPONSE:  {search_data}'
+    GENERIC_SUMMARY_SYSTEM_PROMPT = '''Please generate a concise summary of the following text. Focus on capturing the key points, main ideas, and essential details. The summary should be comprehensive yet brief, offering a clear overview of the text's content.'''
+    SEARCH_QUERY_SYSTEM_PROMPT = "The input that you will receive is an unformatted prompt. I would like you to rewrite the prompt that is sent. You will rewrite the prompt as one singular google search query that is optimized to provide resources that are most likely to answer the users question in the prompt."
+    SEARCH_QUERIES_SYSTEM_PROMPT = "The input that you will receive is an unformatted prompt. Rewrite it as up to {count} different google search queries that are optimized to provide resources that are most likely to answer the users question in the prompt. Vary the wording and angle of each query. Write one query per line, without numbering, quotes or any other text."
+    CONVERSATION_SUMMARY_SYSTEM_PROMPT = '''You keep a running summary of a conversation between a user and an assistant. Merge the summary so far with the turns you are sent into one updated summary of at most {words} words. Keep the topics, names, facts and open questions a follow-up question could refer to, and drop small talk. Summary so far: "{summary}"'''
+    SUMMARY_SYSTEM_PROMPT = '''Please generate a concise summary of the following text. Focus on capturing the key points, main ideas, and essential details that relate to the original question. The summary should be comprehensive yet brief, offering a clear overview of the text's content. Original question: "{original_prompt}"'''
+
+    # Reply length of the running summary that older conversation turns are compacted into
+    CONVERSATION_SUMMARY_MAX_TOKENS = 300
+
+    # Packed summary requests: how many chunks one request may carry, and how sections and their summaries are marked
+    MAX_PACKED_CHUNKS = 4
+    SECTION_MARKER = '=== SECTION {number} ==='
+    SUMMARY_MARKER = re.compile(r'^### SUMMARY (\d+) ###[ \t]*$', re.MULTILINE)
+    PACKED_SUMMARY_INSTRUCTIONS = '''The text is split into {count} sections, each starting with a line like "=== SECTION 1 ===". Summarize every section separately and in order, each in at most {words} words. Start each summary with a line containing only "### SUMMARY n ###", where n is the section number, and write nothing outside the summaries.'''
 
     def __init__(self,
-        openai_api_key: str = os.getenv('OPENAI_API_KEY'),
-        google_custom_search_api: str = os.getenv('GOOGLE_CUSTOM_SEARCH_API'),
-        cx: str = os.getenv('CX')
+        openai_api_key: str = None,
+        google_custom_search_api: str = None,
+        cx: str = None,
+        http_client: HttpClient = None,
+        parse_backend: str = 'inline',
+        parse_workers: int = None,
+        use_cache: bool = True,
+        cache_dir: str = None,
+        search_cache_ttl: float = GoogleSearcher.CACHE_TTL,
+        question_independent_summaries: bool = False,
+        scheduler: RequestScheduler = None,
+        min_sources: int = None,
+        metrics: MetricsRegistry = None,
+        trace_exporter = None,
+        relevance_ranking: bool = True,
+        deduplicate: bool = True,
+        pack_summaries: bool = True,
+        search_queries: int = SEARCH_QUERIES,
+        search_pages: int = SEARCH_PAGES,
+        search_quota: int = SEARCH_QUOTA,
+        hedged_fetches: bool = True,
+        domain_health: DomainHealth = None,
+        answer_cache_ttl: float = ANSWER_CACHE_TTL,
+        fuzzy_answer_matching: bool = False
     ):
-        # Initialize ChatGPT, GPT-4, and GoogleSearcher with respective API keys and settings
-        self.chat_gpt = ChatGpt(openai_api_key)
-        self.gpt_4 = Gpt4(openai_api_key)
-        self.google_searcher = GoogleSearcher(google_custom_search_api, cx)
-
-    async def get_response(self, prompt: str):
-        # Generate a search query and perform a Google search
-        google_search_query = await self.generate_search_query(prompt)
-        urls = await self.google_searcher.perform_search(google_search_query)
-        # Extract text from the fetched URLs and summarize it
-        context = await extract_text_from_websites(urls)
-        summary = await self.summarize_text(context, prompt)
-        # Truncate the summary to a predefined maximum character length
-        summary = summary[:self.MAX_CHARS]
-        # Get a response based on the prompt and the summarized search data
-        answer = await self.get_response_with_search_data(prompt, summary)
-        return answer
-
-    async def get_response_with_search_data(self, prompt, search_data):
-        # Define the settings for the ChatGPT model including the search data
-        model_settings = {
-            'model': 'gpt-3.5-turbo-16k',
+        # Keys that are not passed are read from the environment or a .env file, when the instance is created
+        load_dotenv()
+        openai_api_key = openai_api_key if openai_api_key is not None else os.getenv('OPENAI_API_KEY')
+        google_custom_search_api = google_custom_search_api if google_custom_search_api is not None else os.getenv('GOOGLE_CUSTOM_SEARCH_API')
+        cx = cx if cx is not None else os.getenv('CX')
+
+        # One pooled transport shared by every component so connections stay warm between calls
+        self.http_client = http_client if http_client is not None else HttpClient()
+
+        # One scheduler for every OpenAI request so rate limits and priorities apply across models
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+
+        # Initialize ChatGPT, GPT-4, GoogleSearcher and WebScraper with respective API keys and settings
+        self.chat_gpt = ChatGpt(openai_api_key, self.http_client, self.scheduler)
+        self.gpt_4 = Gpt4(openai_api_key, self.http_client, self.scheduler)
+
+        # Persistent caches live in cache_dir; with use_cache off nothing is read or written
+        self.use_cache = use_cache
+        self.cache_dir = cache_dir if cache_dir is not None else default_cache_dir()
+        self.search_cache = DiskCache(os.path.join(self.cache_dir, 'search.sqlite3'), max_entries=5000) if use_cache else None
+        self.google_searcher = GoogleSearcher(google_custom_search_api, cx, self.http_client,
+                                              self.search_cache, search_cache_ttl)
+
+        # HTML parsing runs inline, or on a thread or process pool so the event loop stays responsive
+        self.parse_executor = ParseExecutor(parse_backend, parse_workers)
+        # Scraped pages are cached with their validators so popular URLs cost one conditional request
+        self.page_cache = DiskCache(os.path.join(self.cache_dir, 'pages.sqlite3'), max_bytes=100 * 1024 * 1024) if use_cache else None
+        # Slow sources get a spare search result fetched alongside them unless hedged_fetches is off
+        self.web_scraper = WebScraper(self.http_client, parse_executor=self.parse_executor, page_cache=self.page_cache,
+                                      domain_health=domain_health, hedging=hedged_fetches)
+
+        # Chunk summaries are memoized by content hash, per question unless question_independent_summaries is set
+        self.summary_cache = SummaryCache(
+            DiskCache(os.path.join(self.cache_dir, 'summaries.sqlite3'), max_entries=20000),
+            question_independent_summaries
+        ) if use_cache else None
+        self.question_independent_summaries = question_independent_summaries
+
+        # Recent final answers with the sources they were built from, so a repeated question skips the whole pipeline
+        self.answer_cache = AnswerCache(
+            answer_cache_ttl,
+            min(self.ANSWER_FRESH_FOR, answer_cache_ttl),
+            fuzzy_threshold=self.ANSWER_FUZZY_THRESHOLD if fuzzy_answer_matching else None
+        ) if use_cache and answer_cache_ttl else None
+
+        # How widely each question searches, and how many Custom Search calls it may spend doing so
+        self.search_queries = search_queries
+        self.search_pages = search_pages
+        self.search_quota = search_quota
+
+        # When set, the answer starts as soon as this many sources have been summarized
+        self.min_sources = min_sources
+
+        # Whether only the chunks most relevant to the question and search query are summarized
+        self.relevance_ranking = relevance_ranking
+        # Whether paragraphs repeated across sources, such as syndicated wire stories, are summarized only once
+        self.deduplicate = deduplicate
+        # Whether several chunks of a source share one summary request instead of paying for one request each
+        self.pack_summaries = pack_summaries
+
+        # Conversation compactions still running, cancelled on close
+        self.compactions = set()
+
+        # Every question is traced; finished traces are added to the metrics and handed to the optional exporter
+        self.metrics = metrics if metrics is not None else MetricsRegistry()
+        self.trace_exporter = trace_exporter
+
+        # Planner deciding how much scraped text is worth summarizing for the final answer
+        self.budget_planner = TokenBudgetPlanner(
+            answer_model=self.ANSWER_MODEL,
+            answer_max_tokens=self.ANSWER_MAX_TOKENS,
+            summary_model=self.SUMMARY_MODEL,
+            summary_max_tokens=self.SUMMARY_MAX_TOKENS,
+            max_chunks=self.MAX_SUMMARY_CHUNKS
+        )
+
+    async def close(self):
+        # Stop background conversation compactions, then release the pooled connections and stop any parse workers
+        for task in self.compactions:
+            task.cancel()
+        await self.http_client.close()
+        self.parse_executor.shutdown(wait=False)
+        for cache in (self.search_cache, self.page_cache, self.summary_cache):
+            if cache is not None:
+                cache.close()
+
+    def coalescing_stats(self) -> dict:
+        # How many searches, page downloads and completions were shared with an identical call already in flight
+        return {
+            'search': self.google_searcher.single_flight.stats(),
+            'pages': self.web_scraper.single_flight.stats(),
+            'chat_gpt': self.chat_gpt.single_flight.stats(),
+            'gpt_4': self.gpt_4.single_flight.stats(),
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    async def get_response(self, prompt: str, bypass_cache: bool = False, trace: Trace = None,
+                           conversation: Conversation = None):
+        # Pass a Trace to inspect where this question's time, bytes, tokens and cost went,
+        # and a Conversation to answer follow-up questions in the context of the earlier ones
+        trace = trace if trace is not None else Trace(prompt=prompt)
+        error = None
+        try:
+            with trace_context(trace):
+                history = await self.get_history(conversation)
+                cached = await self.get_cached_answer(prompt, history, bypass_cache)
+                if cached is not None:
+                    answer = self.cached_response(cached)
+                else:
+                    sources = []
+                    search_data = await self.get_search_data(prompt, bypass_cache, history, sources)
+                    # Get a response based on the prompt and the summarized search data
+                    answer = await self.get_response_with_search_data(prompt, search_data, history)
+                    self.cache_answer(prompt, history, answer['choices'][0]['message']['content'], sources)
+            if conversation is not None:
+                self.remember(conversation, prompt, answer['choices'][0]['message']['content'])
+            return answer
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            self.finish_trace(trace, error)
+
+    async def stream_response(self, prompt: str, bypass_cache: bool = False, trace: Trace = None,
+                              conversation: Conversation = None):
+        # Same pipeline as get_response, but the answer is yielded piece by piece as it is generated
+        trace = trace if trace is not None else Trace(prompt=prompt)
+        error = None
+        try:
+            with trace_context(trace):
+                history = await self.get_history(conversation)
+                cached = await self.get_cached_answer(prompt, history, bypass_cache)
+                answer = []
+                if cached is not None:
+                    answer.append(cached)
+                    yield cached
+                else:
+                    sources = []
+                    search_data = await self.get_search_data(prompt, bypass_cache, history, sources)
+                    async for delta in self.stream_response_with_search_data(prompt, search_data, history):
+                        answer.append(delta)
+                        yield delta
+                    self.cache_answer(prompt, history, ''.join(answer), sources)
+            # An answer that was stopped part way is not remembered
+            if conversation is not None:
+                self.remember(conversation, prompt, ''.join(answer))
+        except BaseException as exception:
+            error = exception
+            raise
+        finally:
+            self.finish_trace(trace, error)
+
+    async def get_cached_answer(self, prompt: str, history: list, bypass_cache: bool = False) -> str:
+        # A follow-up depends on the turns before it, so only questions asked without history are served from the cache
+        if self.answer_cache is None or history or bypass_cache:
+            return None
+        entry = self.answer_cache.get(prompt)
+        if entry is not None and self.answer_cache.needs_validation(entry):
+            # Past its fresh period an answer is reused only if every source still answers 304 Not Modified
+            with span('revalidate_answer', sources=len(entry.urls)):
+                unchanged = await asyncio.gather(*(self.web_scraper.is_unchanged(url) for url in entry.urls))
+            if entry.urls and all(unchanged):
+                self.answer_cache.mark_validated(entry)
+            else:
+                self.answer_cache.discard(entry)
+                entry = None
+        record_cache('answers', entry is not None)
+        return entry.answer if entry is not None else None
+
+    def cache_answer(self, prompt: str, history: list, answer: str, sources: list):
+        if self.answer_cache is not None and not history and answer:
+            self.answer_cache.set(prompt, answer, sources)
+
+    @staticmethod
+    def cached_response(answer: str) -> dict:
+        # A cached answer in the shape of a chat completion, so callers handle both the same way
+        return {'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': answer}, 'finish_reason': 'stop'}]}
+
+    async def get_history(self, conversation: Conversation = None) -> list:
+        # The earlier turns to send with a question, once any compaction of older turns has finished
+        if conversation is None:
+            return []
+        if conversation.compaction is not None and not conversation.compaction.cancelled():
+            # Shielded so stopping this question does not lose the summary of the turns being compacted
+            await asyncio.shield(conversation.compaction)
+        return conversation.messages()
+
+    def remember(self, conversation: Conversation, prompt: str, answer: str):
+        # Record the turn; turns pushed out of the window are compacted in the background while the user reads
+        conversation.add_turn(prompt, answer)
+        if conversation.evicted and (conversation.compaction is None or conversation.compaction.done()):
+            conversation.compaction = asyncio.create_task(self.compact_conversation(conversation))
+            self.compactions.add(conversation.compaction)
+            conversation.compaction.add_done_callback(self.compactions.discard)
+
+    async def compact_conversation(self, conversation: Conversation):
+        # Fold the turns that left the window into the running summary, so the history stays bounded
+        while conversation.evicted:
+            turns = conversation.take_evicted()
+            transcript = '\n\n'.join(f'User: {question}\nAssistant: {answer}' for question, answer in turns)
+            try:
+                response = await self.chat_gpt.get_response(transcript, model_settings={
+                    'model': self.SUMMARY_MODEL,
+                    'messages': [
+                        {'role': 'system', 'content': self.CONVERSATION_SUMMARY_SYSTEM_PROMPT.format(
+                            words=self.CONVERSATION_SUMMARY_MAX_TOKENS * 3 // 4, summary=conversation.summary
+                        )}
+                    ],
+                    'frequency_penalty': 0,
+                    'presence_penalty': 0,
+                    'max_tokens': self.CONVERSATION_SUMMARY_MAX_TOKENS,
+                    'n': 1,
+                    'temperature': 0,
+                    'top_p': 1,
+                })
+                conversation.summary = response['choices'][0]['message']['content'].strip()
+            except OpenAiApiError as error:
+                # The turns are dropped rather than kept, so a failing summary cannot let the history grow
+                print(error)
+
+    def finish_trace(self, trace: Trace, error: BaseException = None):
+        trace.finish()
+        self.metrics.record(trace, error)
+        if self.trace_exporter is not None:
+            self.trace_exporter.export(trace)
+
+    async def get_search_data(self, prompt: str, bypass_cache: bool = False, history: list = None,
+                              sources: list = None) -> str:
+        # Generate search queries and perform the Google searches; bypass_cache skips cached results and pages
+        with span('query'):
+            google_search_queries = await self.generate_search_queries(prompt, self.search_queries, history)
+        with span('search', queries=len(google_search_queries)):
+            urls = await self.google_searcher.perform_searches(
+                google_search_queries, self.search_pages, bypass_cache, SearchQuota(self.search_quota),
+                self.MAX_SOURCES + self.SPARE_SOURCES
+            )
+        with span('scrape_and_summarize', sources=len(urls)):
+            return await self.summarize_websites(prompt, urls, bypass_cache, ' '.join(google_search_queries), history,
+                                                 sources)
+
+    async def summarize_websites(self, prompt: str, urls: list, bypass_cache: bool = False, search_query: str = None,
+                                 history: list = None, sources: list = None) -> str:
+        # When sources is given, the URL of every page that is summarized is appended to it
+        # Summarize each page as soon as it is scraped, so latency follows the fastest sources rather than the slowest
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.PIPELINE_DEADLINE
+        plan = self.plan_pipeline(prompt, min(len(urls), self.MAX_SOURCES), history)
+        remaining_chunks = plan.max_chunks
+        summary_tasks = []
+
+        # Chunks of every page are scored against the question and search query as the pages arrive
+        index = RelevanceIndex() if self.relevance_ranking else None
+        relevance_query = f'{prompt} {search_query or ""}'
+        unmatched = []
+        # Paragraphs already seen on an earlier page are dropped before chunking
+        deduplicator = ParagraphDeduplicator() if self.deduplicate else None
+
+        # Summaries start while pages are still being scraped, so every exit, Stop and errors during scraping included,
+        # cancels the ones still running; past the deadline, or beyond min_sources, they are not waited for either
+        try:
+            # Links past MAX_SOURCES are spares, started only to replace or race a failing or slow source
+            pages = self.web_scraper.iter_texts_from_websites(urls, bypass_cache, deadline, self.MAX_SOURCES)
+            try:
+                async for url, text in pages:
+                    # Keep this page's share of the chunk budget and start summarizing it right away
+                    quota = min(plan.chunks_per_source[0], remaining_chunks)
+                    if deduplicator is not None:
+                        text = deduplicator.filter(text)
+                    chunks = split_tokens(text, plan.chunk_tokens, self.SUMMARY_MODEL)
+                    if index is not None:
+                        # Send only the page's most relevant chunks; a page with none is kept aside in case no page matches
+                        selected = index.top(relevance_query, quota, index.add(chunks))
+                        if not selected:
+                            unmatched.append((url, chunks[:quota]))
+                            continue
+                        chunks = [index.chunks[position] for position in selected]
+                    chunks = chunks[:quota]
+                    if not chunks:
+                        continue
+                    remaining_chunks -= len(chunks)
+                    summary_tasks.append(asyncio.create_task(
+                        self.summarize_chunks(chunks, prompt, plan.summary_tokens, bypass_cache)
+                    ))
+                    if sources is not None:
+                        sources.append(url)
+                    # Stop scraping once the whole chunk budget is spoken for
+                    if remaining_chunks <= 0:
+                        break
+            finally:
+                await pages.aclose()
+                if deduplicator is not None:
+                    record_count('dedup_total_chars', deduplicator.total_chars)
+                    record_count('dedup_removed_chars', deduplicator.removed_chars)
+
+            # When nothing matched the query at all, fall back to the leading chunks of the pages that were scraped
+            if not summary_tasks:
+                for url, chunks in unmatched:
+                    chunks = chunks[:remaining_chunks]
+                    if chunks:
+                        remaining_chunks -= len(chunks)
+                        summary_tasks.append(asyncio.create_task(
+                            self.summarize_chunks(chunks, prompt, plan.summary_tokens, bypass_cache)
+                        ))
+                        if sources is not None:
+                            sources.append(url)
+
+            # Raise an error if no text was extracted
+            if not summary_tasks:
+                raise HttpsError('Failed to extract text from the provided URLs.')
+
+            summaries = await self.collect_summaries(summary_tasks, deadline)
+        finally:
+            for task in summary_tasks:
+                task.cancel()
+
+        # Truncate the summaries to the tokens left for search data in the final request
+        return truncate_tokens(''.join(summaries), plan.context_tokens, self.ANSWER_MODEL)
+
+    async def collect_summaries(self, summary_tasks: list, deadline: float) -> list:
+        # Gather page summaries in completion order until all are done, the deadline passes or min_sources are in
+        loop = asyncio.get_running_loop()
+        summaries = []
+        pending = set(summary_tasks)
+        while pending:
+            # Past the deadline, still wait for the first summary so the answer has some context
+            wait_time = max(deadline - loop.time(), 0) if summaries else None
+            done, pending = await asyncio.wait(pending, timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                break
+            for task in done:
+                if not task.exception() and task.result():
+                    summaries.append(task.result())
+            if self.min_sources is not None and len(summaries) >= self.min_sources:
+                break
+        return summaries
+
+    def get_answer_settings(self, search_data: str, history: list = None) -> dict:
+        # Define the settings for the ChatGPT model including the search data and any earlier turns
+        return {
+            'model': self.ANSWER_MODEL,
             'messages': [
-                {'role': 'system', 'content': f'Please use the following realtime data from the internet to aid in the answering of the prompt. Please do not remind the user that you do not have internet access. They already know. \n DATA TO HELP AID RESPONSE:  {search_data}'}
+                {'role': 'system', 'content': self.ANSWER_SYSTEM_PROMPT.format(search_data=search_data)},
+                *(history or [])
             ],
             'frequency_penalty': 0,
             'presence_penalty': 0,
-            'max_tokens': 1000,
+            'max_tokens': self.ANSWER_MAX_TOKENS,
             'n': 1,
             'temperature': 1,           
             'top_p': 1
         } 
-        # Get a response from the ChatGPT model
-        response = await self.chat_gpt.get_response(prompt, model_settings=model_settings)
+
+    async def get_response_with_search_data(self, prompt, search_data, history: list = None):
+        # Get a response from the ChatGPT model ahead of any background summaries
+        with span('answer'):
+            response = await self.chat_gpt.get_response(prompt, model_settings=self.get_answer_settings(search_data, history), priority=PRIORITY_HIGH)
         return response
 
-    async def generate_search_query(self, prompt: str) -> str:
-        # Get a response from ChatGPT to generate a search query
+    async def stream_response_with_search_data(self, prompt, search_data, history: list = None):
+        # Stream the response so the first words can be shown long before the answer is complete
+        with span('answer'):
+            async for delta in self.chat_gpt.stream_response(prompt, model_settings=self.get_answer_settings(search_data, history), priority=PRIORITY_HIGH):
+                yield delta
+
+    async def generate_search_query(self, prompt: str, history: list = None) -> str:
+        # Get a response from ChatGPT to generate a search query; earlier turns resolve what a follow-up refers to
         response = await self.chat_gpt.get_response(prompt, model_settings = {
             'model': 'gpt-3.5-turbo',
             'messages': [
-                {'role': 'system', 'content': "The input that you will receive is an unformatted prompt. I would like you to rewrite the prompt that is sent. You will rewrite the prompt as one singular google search query that is optimized to provide resources that are most likely to answer the users question in the prompt."}
+                {'role': 'system', 'content': self.SEARCH_QUERY_SYSTEM_PROMPT},
+                *(history or [])
             ],
             'frequency_penalty': 0,
             'presence_penalty': 0,
@@ -66,43 +481,203 @@ class NewsGPT:
             'n': 1,
             'temperature': 1,
             'top_p': 1,
-        })
+        }, priority=PRIORITY_HIGH)
         # Clean and return the generated search query
         response_string = response['choices'][0]['message']['content']
         response_string = response_string.replace('"', '')
         return response_string  
 
+    async def generate_search_queries(self, prompt: str, count: int, history: list = None) -> list:
+        # A single variant keeps the original one-query request
+        if count <= 1:
+            return [await self.generate_search_query(prompt, history)]
+        response = await self.chat_gpt.get_response(prompt, model_settings = {
+            'model': 'gpt-3.5-turbo',
+            'messages': [
+                {'role': 'system', 'content': self.SEARCH_QUERIES_SYSTEM_PROMPT.format(count=count)},
+                *(history or [])
+            ],
+            'frequency_penalty': 0,
+            'presence_penalty': 0,
+            'max_tokens': 1000,
+            'n': 1,
+            'temperature': 1,
+            'top_p': 1,
+        }, priority=PRIORITY_HIGH)
+        # One query per line; numbering, bullets and quotes the model adds anyway are stripped
+        lines = response['choices'][0]['message']['content'].replace('"', '').splitlines()
+        queries = [re.sub(r'^\s*(?:\d+[.)]|[-*\u2022])\s*', '', line).strip() for line in lines]
+        queries = [query for query in queries if query][:count]
+        # Fall back to the question itself when the reply holds no usable query
+        return queries or [prompt]
+
+    def plan_summaries(self, prompt: str, sources: list, search_query: str = None):
+        # Decide how many chunks to summarize, how large they are and which chunks of each source to keep
+        if self.deduplicate:
+            sources, report = deduplicate_texts(sources)
+            record_count('dedup_total_chars', report['total_chars'])
+            record_count('dedup_removed_chars', report['removed_chars'])
+        return self.budget_planner.plan(
+            prompt,
+            sources,
+            self.ANSWER_SYSTEM_PROMPT.format(search_data=''),
+            self.get_summary_system_prompt(prompt),
+            f'{prompt} {search_query or ""}' if self.relevance_ranking else None
+        )
+
+    def plan_pipeline(self, prompt: str, source_count: int, history: list = None):
+        # Decide chunk size, summary length and each source's share before any page has arrived
+        return self.budget_planner.plan_stream(
+            prompt,
+            source_count,
+            self.ANSWER_SYSTEM_PROMPT.format(search_data=''),
+            self.get_summary_system_prompt(prompt),
+            history
+        )
+
+    def get_summary_system_prompt(self, original_prompt: str) -> str:
+        # A question-independent summary must not mention the question it was first made for
+        if self.question_independent_summaries:
+            return self.GENERIC_SUMMARY_SYSTEM_PROMPT
+        return self.SUMMARY_SYSTEM_PROMPT.format(original_prompt=original_prompt)
+
     async def summarize_text(self, text: str, original_prompt: str) -> str:
-        iter_amount = 3000
-        summaries = ''
-        # Helper function to get model settings
-        def get_model_settings():
-            model_settings = {
-                'model': 'gpt-3.5-turbo',
-                'messages': [       
-                    {'role': 'system', 'content': f'''Please generate a concise summary of the following text. Focus on capturing the key points, main ideas, and essential details that relate to the original question. The summary should be comprehensive yet brief, offering a clear overview of the text's content. Original question: "{original_prompt}"'''}
-                ],
-                'frequency_penalty': 0,
-                'presence_penalty': 0,
-                'max_tokens': 1000,
-                'n': 1,
-                'temperature': 1,
-                'top_p': 1, 
-            } 
-            return model_settings
-        
-        tasks = []
-
-        # Divide text into chunks and create tasks for summarizing each chunk
-        for i in range(0, len(text), iter_amount):
-            task = asyncio.create_task(self.chat_gpt.get_response(text[i:i+iter_amount], model_settings=get_model_settings()))
-            tasks.append(task)
-            await asyncio.sleep(0.2)
-        
-        # Collect and concatenate summaries from each chunk
-        summary_responses = await asyncio.gather(*tasks, return_exceptions=True)
-        for summary_response in summary_responses:
-            if 'choices' in summary_response:
-                summaries += summary_response['choices'][0]['message']['content']
-        
-        return summaries    
+        # Summarize a single block of text within the same budget as get_response
+        plan = self.plan_summaries(original_prompt, [text])
+        return await self.summarize_chunks(plan.chunks, original_prompt, plan.summary_tokens)
+
+
+    def get_summary_settings(self, original_prompt: str, max_tokens: int, system_prompt: str = None) -> dict:
+        # Define the settings for a summary request
+        return {
+            'model': self.SUMMARY_MODEL,
+            'messages': [       
+                {'role': 'system', 'content': system_prompt or self.get_summary_system_prompt(original_prompt)}
+            ],
+            'frequency_penalty': 0,
+            'presence_penalty': 0,
+            'max_tokens': max_tokens,
+            'n': 1,
+            'temperature': 1,
+            'top_p': 1, 
+        }
+
+    def get_packed_system_prompt(self, original_prompt: str, count: int, section_tokens: int) -> str:
+        # The word limit is each section's share of the reply, so a model that follows it is never cut off
+        instructions = self.PACKED_SUMMARY_INSTRUCTIONS.format(count=count, words=max(section_tokens * 3 // 4, 1))
+        return f'{self.get_summary_system_prompt(original_prompt)}\n\n{instructions}'
+
+    def pack_chunks(self, chunks: list, original_prompt: str, max_tokens: int) -> list:
+        """
+        Groups consecutive chunks into packs that fit one summary request.
+
+        Args:
+            chunks (list): The chunks to summarize, in order.
+            original_prompt (str): The user's question, part of the system prompt.
+            max_tokens (int): The summary length wanted for each chunk.
+
+        Returns:
+            list: Lists of chunks; a pack of one is summarized on its own.
+        """
+        window = CONTEXT_WINDOWS.get(self.SUMMARY_MODEL, CONTEXT_WINDOWS['gpt-3.5-turbo'])
+        overhead = count_tokens(self.get_packed_system_prompt(original_prompt, self.MAX_PACKED_CHUNKS, max_tokens),
+                                self.SUMMARY_MODEL) + self.budget_planner.safety_margin
+        # The reply room left by the input is shared by the sections; a pack is closed before any section's share
+        # would drop below a useful summary
+        section_reply = min(max_tokens, self.budget_planner.min_summary_tokens)
+        packs = []
+        pack = []
+        pack_tokens = 0
+        for chunk in chunks:
+            tokens = count_tokens(chunk, self.SUMMARY_MODEL) + 8
+            reply_room = window - overhead - pack_tokens - tokens
+            if pack and (len(pack) >= self.MAX_PACKED_CHUNKS or reply_room // (len(pack) + 1) < section_reply):
+                packs.append(pack)
+                pack = []
+                pack_tokens = 0
+            pack.append(chunk)
+            pack_tokens += tokens
+        if pack:
+            packs.append(pack)
+        return packs
+
+    def parse_packed_summaries(self, text: str, count: int) -> list:
+        # Split a packed reply into its summaries, or return None unless every section has exactly one, in order
+        markers = list(self.SUMMARY_MARKER.finditer(text))
+        if [int(marker.group(1)) for marker in markers] != list(range(1, count + 1)):
+            return None
+        ends = [marker.start() for marker in markers[1:]] + [len(text)]
+        summaries = [text[marker.end():end].strip() for marker, end in zip(markers, ends)]
+        return summaries if all(summaries) else None
+
+    async def summarize_chunk(self, chunk: str, original_prompt: str, max_tokens: int) -> dict:
+        # Summaries are reusable like the cached ones, so identical chunks from concurrent questions share a request
+        response = await self.chat_gpt.get_response(chunk, model_settings=self.get_summary_settings(original_prompt, max_tokens),
+                                                    priority=PRIORITY_LOW, coalesce=True)
+        return {chunk: response['choices'][0]['message']['content']}
+
+    async def summarize_pack(self, pack: list, original_prompt: str, max_tokens: int) -> dict:
+        # Summarize several chunks in one request, falling back to one request per chunk if the reply cannot be split
+        window = CONTEXT_WINDOWS.get(self.SUMMARY_MODEL, CONTEXT_WINDOWS['gpt-3.5-turbo'])
+        text = '\n\n'.join(f'{self.SECTION_MARKER.format(number=number)}\n{chunk}' for number, chunk in enumerate(pack, 1))
+        # Measured with the longest word limit the prompt can state, then each section gets an even share of the reply
+        longest_prompt = self.get_packed_system_prompt(original_prompt, len(pack), max_tokens)
+        reply_tokens = min(len(pack) * max_tokens, window - self.budget_planner.safety_margin -
+                           count_tokens(longest_prompt, self.SUMMARY_MODEL) - count_tokens(text, self.SUMMARY_MODEL))
+        system_prompt = self.get_packed_system_prompt(original_prompt, len(pack), reply_tokens // len(pack))
+        summaries = None
+        try:
+            response = await self.chat_gpt.get_response(text, model_settings=self.get_summary_settings(original_prompt, reply_tokens, system_prompt),
+                                                        priority=PRIORITY_LOW, coalesce=True)
+            choice = response['choices'][0]
+            # A reply cut off by the token cap lost its last summary, or part of it, so it is not trusted
+            if choice.get('finish_reason') != 'length':
+                summaries = self.parse_packed_summaries(choice['message']['content'], len(pack))
+        except Exception as error:
+            print(error)
+        if summaries is not None:
+            record_count('packed_chunks', len(pack))
+            return dict(zip(pack, summaries))
+
+        record_count('packed_fallbacks')
+        results = await asyncio.gather(*(self.summarize_chunk(chunk, original_prompt, max_tokens) for chunk in pack),
+                                       return_exceptions=True)
+        return {chunk: summary for result in results if isinstance(result, dict) for chunk, summary in result.items()}
+
+    async def summarize_chunks(self, chunks: list, original_prompt: str, max_tokens: int = SUMMARY_MAX_TOKENS,
+                               bypass_cache: bool = False) -> str:
+        # Identical chunks within one request are summarized only once
+        unique_chunks = list(dict.fromkeys(chunks))
+        summaries = {}
+        missing = []
+
+        # Reuse memoized summaries; the scheduler paces the remaining requests within the rate limits
+        for chunk in unique_chunks:
+            if self.summary_cache is not None and not bypass_cache:
+                cached = self.summary_cache.get(chunk, self.SUMMARY_MODEL, original_prompt)
+                record_cache('summaries', cached is not None)
+                if cached is not None:
+                    summaries[chunk] = cached
+                    continue
+            missing.append(chunk)
+
+        # Chunks that fit together share a request when packing is on
+        packs = self.pack_chunks(missing, original_prompt, max_tokens) if self.pack_summaries else [[chunk] for chunk in missing]
+        tasks = [
+            asyncio.create_task(self.summarize_pack(pack, original_prompt, max_tokens)) if len(pack) > 1
+            else asyncio.create_task(self.summarize_chunk(pack[0], original_prompt, max_tokens))
+            for pack in packs
+        ]
+
+        # Collect the new summaries and remember each one for later requests
+        with span('summarize', chunks=len(missing), requests=len(tasks)):
+            results = await asyncio.gather(*tasks, return_exceptions=True)
+        for result in results:
+            if isinstance(result, dict):
+                for chunk, summary in result.items():
+                    summaries[chunk] = summary
+                    if self.summary_cache is not None:
+                        self.summary_cache.set(chunk, self.SUMMARY_MODEL, original_prompt, summary)
+
+        # Concatenate summaries in chunk order
+        return ''.join(summaries[chunk] for chunk in unique_chunks if chunk in summaries)
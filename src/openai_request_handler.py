@@ -1,30 +1,236 @@
 import aiohttp
+import hashlib
 import json
 import asyncio 
-from exceptions import OpenAiApiError
+import heapq
+import itertools
+import random
+import time
+from email.utils import parsedate_to_datetime
+from exceptions import OpenAiApiError, RetryableApiError
+from http_client import HttpClient
+from token_budget import count_message_tokens, count_tokens
+from single_flight import SingleFlight
+from tracing import span, record_usage, record_retry
 
 # Set a timeout for all HTTP requests
 timeout = aiohttp.ClientTimeout(10)
 
+# Streamed responses may run longer than a single request, but must keep delivering data
+stream_timeout = aiohttp.ClientTimeout(total=None, sock_connect=10, sock_read=30)
+
+# Request priorities; lower values are dispatched first
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+
+# Statuses that signal a temporary condition rather than a bad request
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+# Default requests-per-minute and tokens-per-minute limits per model
+DEFAULT_RATE_LIMITS = {
+    'gpt-3.5-turbo': (3500, 90000),
+    'gpt-3.5-turbo-16k': (3500, 180000),
+    'gpt-4': (500, 10000),
+}
+
+def parse_retry_after(headers) -> float:
+    # Read the server's requested wait from retry-after-ms or Retry-After, in seconds or as an HTTP date
+    if headers.get('retry-after-ms'):
+        try:
+            return float(headers['retry-after-ms']) / 1000
+        except ValueError:
+            pass
+    value = headers.get('Retry-After')
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0)
+    except (TypeError, ValueError):
+        return None
+
+# A token bucket refilled continuously up to a per-minute capacity
+class TokenBucket:
+    def __init__(self, per_minute: float):
+        self.capacity = per_minute
+        self.rate = per_minute / 60
+        self.tokens = per_minute
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, amount: float, now: float) -> float:
+        # Seconds until amount can be taken; requests larger than the bucket wait for a full one
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float):
+        self.tokens -= min(amount, self.capacity)
+
+    def adjust(self, amount: float):
+        # Give back an overestimate, or take more when the real usage was higher
+        self.tokens = min(self.capacity, self.tokens + amount)
+
+# Central scheduler for OpenAI requests: rate limits per model, a concurrency cap, priorities and retries
+class RequestScheduler:
+    def __init__(self,
+        rate_limits: dict = None,
+        max_concurrency: int = 8,
+        max_retries: int = 4,
+        base_delay: float = 0.5,
+        max_delay: float = 20
+    ):
+        self.rate_limits = dict(DEFAULT_RATE_LIMITS, **(rate_limits or {}))
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+        # Buckets per model, created on first use
+        self._buckets = {}
+        # Until when each model is paused after the server asked us to back off
+        self._paused_until = {}
+        # Waiting requests as a heap of (priority, sequence, model, tokens, future)
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._active = 0
+        self._timer = None
+
+        # Counters for measuring throughput and how often requests had to be retried
+        self.requests = 0
+        self.retries = 0
+
+    def _get_buckets(self, model: str) -> tuple:
+        if model not in self._buckets:
+            requests_per_minute, tokens_per_minute = self.rate_limits.get(model, DEFAULT_RATE_LIMITS['gpt-3.5-turbo'])
+            self._buckets[model] = (TokenBucket(requests_per_minute), TokenBucket(tokens_per_minute))
+        return self._buckets[model]
+
+    def _delay(self, model: str, tokens: int, now: float) -> float:
+        request_bucket, token_bucket = self._get_buckets(model)
+        return max(
+            self._paused_until.get(model, 0) - now,
+            request_bucket.delay(1, now),
+            token_bucket.delay(tokens, now)
+        )
+
+    def _dispatch(self):
+        # Start as many waiting requests as the concurrency cap and the rate limits allow, in priority order
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        now = time.monotonic()
+        soonest = None
+        blocked_models = set()
+        still_waiting = []
+        for entry in sorted(self._waiters):
+            _, _, model, tokens, future = entry
+            if future.done():
+                continue
+            if self._active >= self.max_concurrency or model in blocked_models:
+                still_waiting.append(entry)
+                continue
+            delay = self._delay(model, tokens, now)
+            if delay > 0:
+                # Later requests for the same model must not overtake this one
+                blocked_models.add(model)
+                soonest = delay if soonest is None else min(soonest, delay)
+                still_waiting.append(entry)
+                continue
+            request_bucket, token_bucket = self._get_buckets(model)
+            request_bucket.consume(1)
+            token_bucket.consume(tokens)
+            self._active += 1
+            future.set_result(None)
+        self._waiters = still_waiting
+        heapq.heapify(self._waiters)
+        if soonest is not None:
+            self._timer = asyncio.get_running_loop().call_later(soonest, self._dispatch)
+
+    async def acquire(self, model: str, tokens: int, priority: int = PRIORITY_NORMAL):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._sequence), model, tokens, future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            # A slot granted just before cancellation has to be handed back
+            if future.done() and not future.cancelled():
+                self.release(model, tokens, tokens)
+            raise
+
+    def release(self, model: str, estimated_tokens: int, used_tokens: int = None):
+        self._active -= 1
+        if used_tokens is not None:
+            self._get_buckets(model)[1].adjust(estimated_tokens - used_tokens)
+        self._dispatch()
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter exponential backoff
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def retry_delay(self, model: str, error: RetryableApiError, attempt: int) -> float:
+        # Prefer the server's Retry-After over our own backoff and count the retry
+        self.retries += 1
+        record_retry(model)
+        if error.retry_after is None:
+            return self.backoff(attempt)
+        delay = error.retry_after + random.uniform(0, self.base_delay)
+        # Hold back every request for this model until the server is ready again
+        self._paused_until[model] = max(self._paused_until.get(model, 0), time.monotonic() + delay)
+        return delay
+
+    async def submit(self, model: str, tokens: int, send, priority: int = PRIORITY_NORMAL):
+        # Run send() once a slot is free, retrying temporary failures with backoff or the server's Retry-After
+        attempt = 0
+        while True:
+            await self.acquire(model, tokens, priority)
+            used_tokens = None
+            self.requests += 1
+            try:
+                response = await send()
+                used_tokens = response.get('usage', {}).get('total_tokens')
+                return response
+            except RetryableApiError as error:
+                if attempt >= self.max_retries:
+                    raise
+                delay = self.retry_delay(model, error, attempt)
+                attempt += 1
+            finally:
+                self.release(model, tokens, used_tokens)
+            await asyncio.sleep(delay)
+
 # Base class for API interactions
 class APIBase:
     BASE_URL = 'https://api.openai.com/v1'
 
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, http_client: HttpClient = None):
         self.api_key = api_key
+        self.http_client = http_client if http_client is not None else HttpClient()
         # Standard headers for API requests
         self.headers = { 'Content-Type': 'application/json', 'Authorization': 'Bearer ' + api_key}
 
 # Base class for interacting with specific models
 class ModelBase(APIBase):
-    def __init__(self, api_key: str):
-        super().__init__(api_key)
+    def __init__(self, api_key: str, http_client: HttpClient = None, scheduler: RequestScheduler = None):
+        super().__init__(api_key, http_client)
+        # Shared scheduler applying rate limits, priorities and retries; a private one is created when none is injected
+        self.scheduler = scheduler if scheduler is not None else RequestScheduler()
+        # Identical completions running at the same time share one API call
+        self.single_flight = SingleFlight()
         # Settings specific to the model
         self.model_settings = None
         self.model_endpoint = None
 
-    # Method to send a prompt and get a response from the model
-    async def get_response(self, prompt, model_settings: dict = None, headers: dict = None):
+    # Method to validate the settings and build a request with the user's prompt after their messages
+    def prepare_request(self, prompt, model_settings: dict = None, headers: dict = None) -> tuple:
         # Use default model settings if none are provided
         if model_settings is None:  
             model_settings = self.model_settings
@@ -39,28 +245,141 @@ class ModelBase(APIBase):
         if missing_keys:
             raise Exception(f"Must include these default parameters within the model_settings: {', '.join(missing_keys)}")
 
-        # Append the user's prompt to the messages
-        model_settings['messages'].append({'role': 'user', 'content': prompt})
+        # The settings are a template: the request gets its own message list, so no call changes the next one
+        model_settings = dict(model_settings, messages=[*model_settings['messages'], {'role': 'user', 'content': prompt}])
+
+        estimated_tokens = count_message_tokens(model_settings['messages'], model_settings['model']) + model_settings['max_tokens']
+        return model_settings, headers, estimated_tokens
+
+    # Method to check whether a request always produces the same completion, so identical requests are interchangeable
+    @staticmethod
+    def is_deterministic(model_settings: dict) -> bool:
+        return model_settings.get('temperature') == 0 and model_settings.get('n', 1) == 1
 
-        # Perform the HTTP POST request
-        async with aiohttp.ClientSession(timeout=timeout) as session:
+    # Method to send a prompt and get a response from the model
+    async def get_response(self, prompt, model_settings: dict = None, headers: dict = None, priority: int = PRIORITY_NORMAL,
+                           coalesce: bool = None):
+        model_settings, headers, estimated_tokens = self.prepare_request(prompt, model_settings, headers)
+
+        # Send the request through the scheduler, which waits for capacity and retries temporary failures
+        async def send():
+            response = await self.scheduler.submit(
+                model_settings['model'],
+                estimated_tokens,
+                lambda: self.post(model_settings, headers),
+                priority
+            )
+            # Token usage is counted once, by the question whose call actually ran
+            record_usage(model_settings['model'], response.get('usage'))
+            return response
+
+        with span('completion', model=model_settings['model'], priority=priority):
+            # Deterministic requests are coalesced by default; callers that accept any completion can opt in with coalesce
+            if coalesce is None:
+                coalesce = self.is_deterministic(model_settings)
+            if not coalesce:
+                return await send()
+            key = hashlib.sha256(json.dumps([self.model_endpoint, model_settings], sort_keys=True).encode('utf-8')).hexdigest()
+            return await self.single_flight.run(key, send)
+
+    # Method to send a prompt and iterate over the response text as the model produces it
+    async def stream_response(self, prompt, model_settings: dict = None, headers: dict = None, priority: int = PRIORITY_NORMAL):
+        model_settings, headers, estimated_tokens = self.prepare_request(prompt, model_settings, headers)
+        model = model_settings['model']
+        # Ask for a final chunk with the token usage, which streams otherwise do not report
+        payload = dict(model_settings, stream=True, stream_options={'include_usage': True})
+
+        attempt = 0
+        while True:
+            # Hold a scheduler slot for the whole stream; failures are only retried before any text was yielded
+            await self.scheduler.acquire(model, estimated_tokens, priority)
+            yielded = []
+            usage = {}
             try:
-                async with session.post(f'{self.BASE_URL}{self.model_endpoint}',
-                                        headers=headers, data=json.dumps(model_settings)) as response:
-                    if response.status == 200 and response.headers['Content-Type'] == 'application/json':
-                        response_data = await response.json()
-                        if 'choices' in response_data:
-                            return response_data
-                        else:
-                            raise OpenAiApiError(f"Response from {model_settings['model']} model did not include 'choices'.")
+                async for delta in self.post_stream(payload, headers, usage):
+                    yielded.append(delta)
+                    yield delta
+                return
+            except RetryableApiError as error:
+                if yielded or attempt >= self.scheduler.max_retries:
+                    raise
+                delay = self.scheduler.retry_delay(model, error, attempt)
+                attempt += 1
+            finally:
+                # Count what this attempt was billed for, estimated from the request and the text when the server sent
+                # no usage, as when the stream is stopped early, and correct the token bucket with it
+                if yielded and not usage:
+                    prompt_tokens = count_message_tokens(model_settings['messages'], model)
+                    completion_tokens = count_tokens(''.join(yielded), model)
+                    usage = {'prompt_tokens': prompt_tokens, 'completion_tokens': completion_tokens,
+                             'total_tokens': prompt_tokens + completion_tokens}
+                record_usage(model, usage)
+                self.scheduler.release(model, estimated_tokens, usage.get('total_tokens'))
+            await asyncio.sleep(delay)
+
+    # Method to perform a single HTTP POST request over the shared, pooled session
+    async def post(self, model_settings: dict, headers: dict):
+        session = await self.http_client.get_session()
+        try:
+            async with session.post(f'{self.BASE_URL}{self.model_endpoint}',
+                                    headers=headers, data=json.dumps(model_settings), timeout=timeout) as response:
+                if response.status == 200 and response.content_type == 'application/json':
+                    response_data = await response.json()
+                    if 'choices' in response_data:
+                        return response_data
                     else:
-                        raise OpenAiApiError(f"The API request to {model_settings['model']} model failed with status {response.status}.")
-            except asyncio.TimeoutError:
-                raise OpenAiApiError("The request to OpenAI API timed out.")
-            except aiohttp.ClientError as e:
-                raise OpenAiApiError(f"Failed to fetch response due to client error: {str(e)}")
-            except Exception as e:
-                raise OpenAiApiError(f"An unexpected error occurred: {str(e)}")
+                        raise OpenAiApiError(f"Response from {model_settings['model']} model did not include 'choices'.")
+                elif response.status in RETRYABLE_STATUSES:
+                    raise RetryableApiError(f"The API request to {model_settings['model']} model failed with status {response.status}.",
+                                            parse_retry_after(response.headers))
+                else:
+                    raise OpenAiApiError(f"The API request to {model_settings['model']} model failed with status {response.status}.")
+        except OpenAiApiError:
+            raise
+        except asyncio.TimeoutError:
+            raise RetryableApiError("The request to OpenAI API timed out.")
+        except aiohttp.ClientError as e:
+            raise RetryableApiError(f"Failed to fetch response due to client error: {str(e)}")
+        except Exception as e:
+            raise OpenAiApiError(f"An unexpected error occurred: {str(e)}")
+
+    # Method to perform a single streaming HTTP POST request and yield the content of each server-sent event; the
+    # token usage, if the server reports it, is copied into usage
+    async def post_stream(self, model_settings: dict, headers: dict, usage: dict = None):
+        session = await self.http_client.get_session()
+        try:
+            async with session.post(f'{self.BASE_URL}{self.model_endpoint}',
+                                    headers=headers, data=json.dumps(model_settings), timeout=stream_timeout) as response:
+                if response.status in RETRYABLE_STATUSES:
+                    raise RetryableApiError(f"The API request to {model_settings['model']} model failed with status {response.status}.",
+                                            parse_retry_after(response.headers))
+                elif response.status != 200:
+                    raise OpenAiApiError(f"The API request to {model_settings['model']} model failed with status {response.status}.")
+
+                # Each event is a 'data: {json}' line and the stream ends with 'data: [DONE]'
+                async for line in response.content:
+                    line = line.strip()
+                    if not line.startswith(b'data:'):
+                        continue
+                    data = line[len(b'data:'):].strip()
+                    if data == b'[DONE]':
+                        return
+                    event = json.loads(data)
+                    if event.get('usage') and usage is not None:
+                        usage.update(event['usage'])
+                    if not event.get('choices'):
+                        continue
+                    delta = event['choices'][0].get('delta', {}).get('content')
+                    if delta:
+                        yield delta
+        except OpenAiApiError:
+            raise
+        except asyncio.TimeoutError:
+            raise RetryableApiError("The request to OpenAI API timed out.")
+        except aiohttp.ClientError as e:
+            raise RetryableApiError(f"Failed to fetch response due to client error: {str(e)}")
+        except Exception as e:
+            raise OpenAiApiError(f"An unexpected error occurred: {str(e)}")
 
     # Method to update default model settings
     def update_default_settings(self, settings_to_update: dict):
@@ -72,8 +391,8 @@ class ModelBase(APIBase):
 
 # Class for interactions with the ChatGPT model
 class ChatGpt(ModelBase):
-    def __init__(self, api_key: str):
-        super().__init__(api_key)
+    def __init__(self, api_key: str, http_client: HttpClient = None, scheduler: RequestScheduler = None):
+        super().__init__(api_key, http_client, scheduler)
         # Define the endpoint and initial settings for ChatGPT
         self.model_endpoint = '/chat/completions'
         self.model_settings = {
@@ -91,8 +410,8 @@ class ChatGpt(ModelBase):
 
 # Class for interactions with the GPT-4 model
 class Gpt4(ModelBase):
-    def __init__(self, api_key: str):
-        super().__init__(api_key)
+    def __init__(self, api_key: str, http_client: HttpClient = None, scheduler: RequestScheduler = None):
+        super().__init__(api_key, http_client, scheduler)
         # Define the endpoint and initial settings for GPT-4
         self.model_endpoint = '/chat/completions'
         self.model_settings = {
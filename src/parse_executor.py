@@ -0,0 +1,39 @@
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+# Runs the CPU-bound parse-and-extract step inline, on a thread pool or on a process pool
+class ParseExecutor:
+    BACKENDS = ('inline', 'thread', 'process')
+
+    def __init__(self, backend: str = 'inline', max_workers: int = None):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"Unknown parse backend '{backend}', expected one of: {', '.join(self.BACKENDS)}")
+        self.backend = backend
+        self.max_workers = max_workers
+        # The pool is started on first use so an unused backend costs nothing
+        self._executor = None
+
+    @property
+    def inline(self) -> bool:
+        return self.backend == 'inline'
+
+    def _get_executor(self):
+        if self._executor is None:
+            if self.backend == 'thread':
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='newsgpt-parse')
+            else:
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    async def run(self, function, *args):
+        # Inline work runs on the event loop; otherwise only the arguments and the result cross the pool boundary
+        if self.inline:
+            return function(*args)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._get_executor(), functools.partial(function, *args))
+
+    def shutdown(self, wait: bool = True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
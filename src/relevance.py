@@ -0,0 +1,80 @@
+import re
+from collections import Counter
+import numpy as np
+
+# Words too common to say anything about relevance
+STOP_WORDS = frozenset('''
+a about after all also an and any are as at be been but by can could did do does for from had has have he her his how
+i if in into is it its just more most my no not of on or our out she so than that the their them then there these they
+this to up us was we were what when where which who why will with would you your
+'''.split())
+
+WORD = re.compile(r'\w+')
+
+def tokenize(text: str) -> list:
+    return [word for word in WORD.findall(text.lower()) if word not in STOP_WORDS and len(word) > 1]
+
+# A BM25 index over the chunks scraped for one question
+class RelevanceIndex:
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.chunks = []
+        self.term_counts = []
+        self.lengths = []
+        self.document_frequency = Counter()
+
+    def __len__(self):
+        return len(self.chunks)
+
+    def add(self, chunks: list) -> list:
+        # Index the chunks and return their positions in the index
+        start = len(self.chunks)
+        for chunk in chunks:
+            counts = Counter(tokenize(chunk))
+            self.chunks.append(chunk)
+            self.term_counts.append(counts)
+            self.lengths.append(sum(counts.values()))
+            self.document_frequency.update(counts.keys())
+        return list(range(start, len(self.chunks)))
+
+    def scores(self, query: str) -> np.ndarray:
+        # BM25 score of every indexed chunk against the query, computed for all chunks at once
+        terms = list(dict.fromkeys(tokenize(query)))
+        if not self.chunks or not terms:
+            return np.zeros(len(self.chunks))
+        frequencies = np.array([[counts.get(term, 0) for term in terms] for counts in self.term_counts], dtype=float)
+        document_frequency = np.array([self.document_frequency[term] for term in terms], dtype=float)
+        idf = np.log1p((len(self.chunks) - document_frequency + 0.5) / (document_frequency + 0.5))
+        lengths = np.array(self.lengths, dtype=float)
+        normalization = self.k1 * (1 - self.b + self.b * lengths / max(lengths.mean(), 1))
+        weights = frequencies * (self.k1 + 1) / (frequencies + normalization[:, None])
+        return weights @ idf
+
+    def top(self, query: str, k: int, candidates: list = None) -> list:
+        """
+        Picks the chunks most relevant to the query.
+
+        Args:
+            query (str): Text the chunks are scored against.
+            k (int): Maximum number of chunks to return.
+            candidates (list): Positions to choose from; all indexed chunks when omitted.
+
+        Returns:
+            list: Positions of up to k chunks with a positive score, best first.
+        """
+        candidates = np.arange(len(self.chunks)) if candidates is None else np.asarray(candidates, dtype=int)
+        if k <= 0 or not len(candidates):
+            return []
+        scores = self.scores(query)[candidates]
+        order = np.argsort(-scores, kind='stable')[:k]
+        return [int(candidates[i]) for i in order if scores[i] > 0]
+
+def rank_chunks(source_chunks: list, query: str, limit: int) -> list:
+    # Choose up to limit chunks across all sources, returned as (source, position) with the most relevant first
+    index = RelevanceIndex()
+    positions = []
+    for source, chunks in enumerate(source_chunks):
+        index.add(chunks)
+        positions.extend((source, position) for position in range(len(chunks)))
+    return [positions[i] for i in index.top(query, limit)]
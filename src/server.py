@@ -0,0 +1,182 @@
+import argparse
+import asyncio
+import json
+import time
+from aiohttp import web
+from news_gpt import NewsGPT
+from endpoints import add_endpoint_arguments, apply_endpoint_arguments
+from tracing import JsonLinesExporter
+from exceptions import OpenAiApiError, GoogleApiError, HttpsError
+
+# Limits how many questions run at once and how many may wait for a slot
+class AdmissionController:
+    def __init__(self, max_concurrent: int = 16, max_queue: int = 64):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.in_flight = 0
+        self.queued = 0
+        self.rejected = 0
+        self.draining = False
+        self._idle = asyncio.Event()
+        self._idle.set()
+
+    def try_admit(self) -> bool:
+        # Refuse new work while shutting down or when the waiting line is full
+        if self.draining or self.queued >= self.max_queue:
+            self.rejected += 1
+            return False
+        self.queued += 1
+        self._idle.clear()
+        return True
+
+    async def __aenter__(self):
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.in_flight += 1
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        self.in_flight -= 1
+        self.semaphore.release()
+        if not self.in_flight and not self.queued:
+            self._idle.set()
+
+    async def drain(self, timeout: float):
+        # Stop admitting and wait for the questions already accepted to finish
+        self.draining = True
+        try:
+            await asyncio.wait_for(self._idle.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+# Keys under which shared state is stored on the aiohttp application
+NEWS_GPT_KEY = web.AppKey('news_gpt', NewsGPT)
+ADMISSION_KEY = web.AppKey('admission', AdmissionController)
+
+def error_response(status: int, message: str, headers: dict = None) -> web.Response:
+    return web.json_response({'error': message}, status=status, headers=headers)
+
+def describe_error(error: Exception) -> str:
+    # Same wording as the GUI uses for pipeline errors
+    if isinstance(error, OpenAiApiError):
+        return f"OpenAI API error: {error}"
+    elif isinstance(error, GoogleApiError):
+        return f"Google API error: {error}"
+    elif isinstance(error, HttpsError):
+        return f"Https error: {error}"
+    return f"Unexpected error: {error}"
+
+async def read_question(request: web.Request) -> dict:
+    try:
+        body = await request.json()
+    except (json.JSONDecodeError, UnicodeDecodeError):
+        raise web.HTTPBadRequest(text=json.dumps({'error': 'Request body must be JSON.'}), content_type='application/json')
+    prompt = body.get('prompt') if isinstance(body, dict) else None
+    if not isinstance(prompt, str) or not prompt.strip():
+        raise web.HTTPBadRequest(text=json.dumps({'error': "Field 'prompt' must be a non-empty string."}), content_type='application/json')
+    return {'prompt': prompt.strip(), 'bypass_cache': bool(body.get('bypass_cache', False))}
+
+async def handle_ask(request: web.Request) -> web.Response:
+    question = await read_question(request)
+    admission = request.app[ADMISSION_KEY]
+    if not admission.try_admit():
+        return error_response(503, 'Server is busy, try again later.', {'Retry-After': '1'})
+
+    async with admission:
+        started = time.perf_counter()
+        try:
+            response = await request.app[NEWS_GPT_KEY].get_response(question['prompt'], question['bypass_cache'])
+        except Exception as error:
+            return error_response(502, describe_error(error))
+        return web.json_response({
+            'answer': response['choices'][0]['message']['content'],
+            'elapsed': round(time.perf_counter() - started, 3),
+        })
+
+async def handle_ask_stream(request: web.Request) -> web.StreamResponse:
+    question = await read_question(request)
+    admission = request.app[ADMISSION_KEY]
+    if not admission.try_admit():
+        return error_response(503, 'Server is busy, try again later.', {'Retry-After': '1'})
+
+    async with admission:
+        # Deltas are sent as server-sent events, ending with an error event or [DONE]
+        response = web.StreamResponse(headers={'Content-Type': 'text/event-stream', 'Cache-Control': 'no-cache'})
+        await response.prepare(request)
+        try:
+            async for delta in request.app[NEWS_GPT_KEY].stream_response(question['prompt'], question['bypass_cache']):
+                await response.write(f"data: {json.dumps({'delta': delta})}\n\n".encode('utf-8'))
+        except ConnectionResetError:
+            # The client went away; stop the pipeline along with it
+            raise
+        except Exception as error:
+            await response.write(f"data: {json.dumps({'error': describe_error(error)})}\n\n".encode('utf-8'))
+        await response.write(b'data: [DONE]\n\n')
+        await response.write_eof()
+        return response
+
+async def handle_health(request: web.Request) -> web.Response:
+    admission = request.app[ADMISSION_KEY]
+    return web.json_response({
+        'status': 'draining' if admission.draining else 'ok',
+        'in_flight': admission.in_flight,
+        'queued': admission.queued,
+        'rejected': admission.rejected,
+    })
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    # Aggregated timings, bytes, tokens, retries, cache hits and cost over the questions answered so far
+    return web.json_response(request.app[NEWS_GPT_KEY].metrics.snapshot())
+
+def create_app(news_gpt_factory=NewsGPT, max_concurrent: int = 16, max_queue: int = 64, shutdown_grace: float = 30) -> web.Application:
+    """
+    Builds the NewsGPT web application.
+
+    Args:
+        news_gpt_factory: Callable returning the NewsGPT instance shared by every request.
+        max_concurrent (int): Questions answered at the same time.
+        max_queue (int): Questions allowed to wait for a slot before new ones are rejected with 503.
+        shutdown_grace (float): Seconds to let accepted questions finish when the server stops.
+    """
+    app = web.Application()
+
+    async def news_gpt_context(app):
+        # NewsGPT and its pooled clients are created on, and live as long as, the server's event loop
+        app[ADMISSION_KEY] = AdmissionController(max_concurrent, max_queue)
+        app[NEWS_GPT_KEY] = news_gpt_factory()
+        yield
+        await app[NEWS_GPT_KEY].close()
+
+    async def drain(app):
+        await app[ADMISSION_KEY].drain(shutdown_grace)
+
+    app.cleanup_ctx.append(news_gpt_context)
+    app.on_shutdown.append(drain)
+    app.router.add_post('/ask', handle_ask)
+    app.router.add_post('/ask/stream', handle_ask_stream)
+    app.router.add_get('/health', handle_health)
+    app.router.add_get('/metrics', handle_metrics)
+    return app
+
+def main():
+    parser = argparse.ArgumentParser(description='Serve NewsGPT answers over HTTP.')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8080)
+    parser.add_argument('--max-concurrent', type=int, default=16)
+    parser.add_argument('--max-queue', type=int, default=64)
+    parser.add_argument('--shutdown-grace', type=float, default=30)
+    add_endpoint_arguments(parser)
+    parser.add_argument('--trace-file', help='Append the trace of every question to this JSON lines file.')
+    args = parser.parse_args()
+
+    apply_endpoint_arguments(args)
+
+    trace_exporter = JsonLinesExporter(args.trace_file) if args.trace_file else None
+    app = create_app(lambda: NewsGPT(trace_exporter=trace_exporter), max_concurrent=args.max_concurrent, max_queue=args.max_queue, shutdown_grace=args.shutdown_grace)
+    web.run_app(app, host=args.host, port=args.port, shutdown_timeout=args.shutdown_grace)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,60 @@
+import asyncio
+
+# One in-flight call shared by every caller that asked for the same key
+class Flight:
+    def __init__(self, task: asyncio.Task):
+        self.task = task
+        self.waiters = 0
+
+# Coalesces concurrent identical calls so the work runs once and every caller gets its result
+class SingleFlight:
+    def __init__(self):
+        self.flights = {}
+
+        # Counters for measuring how much work coalescing saves
+        self.executed = 0
+        self.coalesced = 0
+
+    async def run(self, key, function):
+        """
+        Runs function() unless a call with the same key is already in flight, in which case its result is shared.
+
+        Args:
+            key: Hashable identity of the call; equal keys must mean interchangeable results.
+            function: Zero-argument callable returning the coroutine that does the work.
+
+        Returns:
+            The result of the shared call. Its exception, if any, is raised to every caller.
+        """
+        flight = self.flights.get(key)
+        if flight is None or flight.task.done():
+            flight = Flight(asyncio.ensure_future(function()))
+            self.flights[key] = flight
+            flight.task.add_done_callback(lambda task: self.forget(key, flight))
+            self.executed += 1
+        else:
+            self.coalesced += 1
+
+        flight.waiters += 1
+        try:
+            # Shielded so one caller giving up does not cancel the work for the others
+            return await asyncio.shield(flight.task)
+        finally:
+            flight.waiters -= 1
+            # The last caller to leave cancels work that nobody is waiting for any more; later callers start afresh
+            if not flight.waiters and not flight.task.done():
+                flight.task.cancel()
+                self.forget(key, flight)
+
+    def forget(self, key, flight: Flight):
+        if self.flights.get(key) is flight:
+            del self.flights[key]
+
+    def stats(self) -> dict:
+        calls = self.executed + self.coalesced
+        return {
+            'executed': self.executed,
+            'coalesced': self.coalesced,
+            'in_flight': len(self.flights),
+            'saved_rate': self.coalesced / calls if calls else 0.0,
+        }
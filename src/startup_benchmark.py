@@ -0,0 +1,112 @@
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+# Modules whose cold import is timed: what the key popup waits for, and what the chat window waits for
+IMPORTED_MODULES = ('gui', 'news_gpt')
+
+def run_child(*arguments: str) -> dict:
+    # Every measurement runs in a fresh interpreter, so no module, connection or tokenizer is already loaded
+    output = subprocess.run([sys.executable, os.path.abspath(__file__), '--child', *arguments],
+                            check=True, capture_output=True, text=True,
+                            cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def time_import(module: str) -> dict:
+    started = time.perf_counter()
+    __import__(module)
+    return {'seconds': time.perf_counter() - started}
+
+async def time_questions(warm: bool, chat_latency: float, search_latency: float, page_latency: float) -> dict:
+    """
+    Times the first two questions of a new session against local stand-in upstreams.
+
+    Args:
+        warm (bool): Whether connections and tokenizers are warmed up before the first question, as the key popup does.
+        chat_latency (float): Seconds each chat completion takes.
+        search_latency (float): Seconds each search takes.
+        page_latency (float): Seconds each page takes.
+
+    Returns:
+        dict: Seconds taken by the warm-up, the first question and the second question.
+    """
+    from news_gpt import NewsGPT, warm_up
+    from fake_upstreams import FakeUpstreams, UpstreamProfile
+    from openai_request_handler import RequestScheduler, DEFAULT_RATE_LIMITS
+    from domain_health import DomainHealth
+
+    upstreams = FakeUpstreams(chat=UpstreamProfile(chat_latency, 0.0), search=UpstreamProfile(search_latency, 0.0),
+                              pages=UpstreamProfile(page_latency, 0.0), seed=1)
+    async with upstreams:
+        upstreams.install()
+        # Limits are lifted as in benchmark.py, so only startup effects separate the two questions
+        scheduler = RequestScheduler({model: (10 ** 9, 10 ** 12) for model in DEFAULT_RATE_LIMITS})
+        domain_health = DomainHealth(per_host_limit=10 ** 6, failure_threshold=10 ** 6)
+        async with NewsGPT('benchmark-key', 'benchmark-key', 'benchmark-cx', use_cache=False,
+                           scheduler=scheduler, domain_health=domain_health) as news_gpt:
+            timings = {'warm_up': 0.0}
+            if warm:
+                started = time.perf_counter()
+                await warm_up(news_gpt.http_client)
+                timings['warm_up'] = time.perf_counter() - started
+            for name, question in (('first_question', 'What is the latest news about topic 1?'),
+                                   ('second_question', 'What is the latest news about topic 2?')):
+                started = time.perf_counter()
+                await news_gpt.get_response(question, bypass_cache=True)
+                timings[name] = time.perf_counter() - started
+            return timings
+
+def median_of(runs: list) -> dict:
+    return {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+def run(args) -> dict:
+    report = {}
+    for module in IMPORTED_MODULES:
+        report[f'import_{module}'] = median_of([run_child('import', module) for _ in range(args.runs)])['seconds']
+    latencies = [str(args.chat_latency), str(args.search_latency), str(args.page_latency)]
+    for mode in ('cold', 'warm'):
+        report[mode] = median_of([run_child('questions', mode, *latencies) for _ in range(args.runs)])
+
+    print(f"{'import':<18}{'ms':>10}")
+    for module in IMPORTED_MODULES:
+        print(f"{module:<18}{report[f'import_{module}'] * 1000:>10.1f}")
+    print(f"{'session':<18}{'warm-up ms':>12}{'first ms':>10}{'second ms':>11}")
+    for mode in ('cold', 'warm'):
+        timings = report[mode]
+        print(f"{mode:<18}{timings['warm_up'] * 1000:>12.1f}{timings['first_question'] * 1000:>10.1f}"
+              f"{timings['second_question'] * 1000:>11.1f}")
+    return report
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure how quickly NewsGPT starts and answers its first question.')
+    parser.add_argument('--runs', type=int, default=5, help='Fresh processes per measurement; the median is reported.')
+    parser.add_argument('--chat-latency', type=float, default=0.2)
+    parser.add_argument('--search-latency', type=float, default=0.1)
+    parser.add_argument('--page-latency', type=float, default=0.1)
+    parser.add_argument('--json', help='Also write the results to this file.')
+    parser.add_argument('--child', nargs='+', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        # One measurement inside a fresh interpreter, reported to the parent as a JSON line
+        kind, *arguments = args.child
+        if kind == 'import':
+            result = time_import(arguments[0])
+        else:
+            mode, *latencies = arguments
+            result = asyncio.run(time_questions(mode == 'warm', *(float(latency) for latency in latencies)))
+        print(json.dumps(result))
+        return
+
+    report = run(args)
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump(report, file, indent=2)
+
+if __name__ == '__main__':
+    main()
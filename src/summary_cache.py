@@ -0,0 +1,40 @@
+import hashlib
+import re
+from disk_cache import DiskCache
+
+# Punctuation that does not change what a question asks
+PUNCTUATION = re.compile(r'[^\w\s]')
+
+def normalize_question(question: str) -> str:
+    return ' '.join(PUNCTUATION.sub(' ', question.lower()).split())
+
+# Memoizes chunk summaries by a hash of the chunk text, the model and the normalized question
+class SummaryCache:
+    # Summaries of identical text stay valid for a long time, unlike search results
+    MAX_AGE = 7 * 24 * 60 * 60
+
+    def __init__(self, cache: DiskCache, question_independent: bool = False, max_age: float = MAX_AGE):
+        self.cache = cache
+        # In question-independent mode one summary of a chunk is reused for every question
+        self.question_independent = question_independent
+        self.max_age = max_age
+
+    def key(self, chunk: str, model: str, question: str) -> str:
+        question = '' if self.question_independent else normalize_question(question)
+        digest = hashlib.sha256()
+        for part in (model, question, chunk):
+            digest.update(part.encode('utf-8', errors='replace'))
+            digest.update(b'\0')
+        return digest.hexdigest()
+
+    def get(self, chunk: str, model: str, question: str) -> str:
+        return self.cache.get(self.key(chunk, model, question), max_age=self.max_age)
+
+    def set(self, chunk: str, model: str, question: str, summary: str):
+        self.cache.set(self.key(chunk, model, question), summary)
+
+    def stats(self) -> dict:
+        return self.cache.stats()
+
+    def close(self):
+        self.cache.close()
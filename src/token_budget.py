@@ -0,0 +1,176 @@
+import math
+from relevance import rank_chunks
+
+try:
+    import tiktoken
+except ImportError:
+    # Without tiktoken, token counts fall back to a rough characters-per-token estimate
+    tiktoken = None
+
+# Context window sizes, in tokens, of the models used by NewsGPT
+CONTEXT_WINDOWS = {
+    'gpt-3.5-turbo': 4096,
+    'gpt-3.5-turbo-16k': 16385,
+    'gpt-4': 8192,
+}
+
+# Tokens the chat format adds for every message and for priming the reply
+TOKENS_PER_MESSAGE = 4
+TOKENS_PER_REPLY = 3
+
+# Average characters per token used when tiktoken is not installed
+CHARS_PER_TOKEN = 4
+
+_encodings = {}
+
+def get_encoding(model: str):
+    # Cache one tokenizer per model because building an encoding is expensive
+    if tiktoken is None:
+        return None
+    if model not in _encodings:
+        try:
+            try:
+                _encodings[model] = tiktoken.encoding_for_model(model)
+            except KeyError:
+                _encodings[model] = tiktoken.get_encoding('cl100k_base')
+        except Exception:
+            # The encoding files could not be loaded, for example offline, so estimate instead
+            _encodings[model] = None
+    return _encodings[model]
+
+def count_tokens(text: str, model: str = 'gpt-3.5-turbo') -> int:
+    encoding = get_encoding(model)
+    if encoding is None:
+        return math.ceil(len(text) / CHARS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+def count_message_tokens(messages: list, model: str = 'gpt-3.5-turbo') -> int:
+    # Count the tokens of a chat request the same way the API bills them
+    total = TOKENS_PER_REPLY
+    for message in messages:
+        total += TOKENS_PER_MESSAGE + count_tokens(message['content'], model)
+    return total
+
+def split_tokens(text: str, chunk_tokens: int, model: str = 'gpt-3.5-turbo') -> list:
+    # Split text into consecutive pieces of at most chunk_tokens tokens
+    encoding = get_encoding(model)
+    if encoding is None:
+        size = chunk_tokens * CHARS_PER_TOKEN
+        return [text[i:i + size] for i in range(0, len(text), size)]
+    tokens = encoding.encode(text, disallowed_special=())
+    return [encoding.decode(tokens[i:i + chunk_tokens]) for i in range(0, len(tokens), chunk_tokens)]
+
+def truncate_tokens(text: str, max_tokens: int, model: str = 'gpt-3.5-turbo') -> str:
+    pieces = split_tokens(text, max(max_tokens, 1), model)
+    return pieces[0] if pieces else ''
+
+# The outcome of planning: what to summarize and how long each summary may be
+class BudgetPlan:
+    def __init__(self, chunks: list, chunk_tokens: int, summary_tokens: int, context_tokens: int, chunks_per_source: list,
+                 max_chunks: int = None):
+        self.chunks = chunks
+        self.chunk_tokens = chunk_tokens
+        self.summary_tokens = summary_tokens
+        self.context_tokens = context_tokens
+        self.chunks_per_source = chunks_per_source
+        self.max_chunks = max_chunks if max_chunks is not None else len(chunks)
+
+# Works out up front how much scraped text is worth summarizing for the final answer
+class TokenBudgetPlanner:
+    def __init__(self,
+        answer_model: str = 'gpt-3.5-turbo-16k',
+        answer_max_tokens: int = 1000,
+        summary_model: str = 'gpt-3.5-turbo',
+        summary_max_tokens: int = 1000,
+        max_chunk_tokens: int = 1500,
+        min_summary_tokens: int = 150,
+        max_chunks: int = 12,
+        safety_margin: int = 64
+    ):
+        self.answer_model = answer_model
+        self.answer_max_tokens = answer_max_tokens
+        self.summary_model = summary_model
+        self.summary_max_tokens = summary_max_tokens
+        self.max_chunk_tokens = max_chunk_tokens
+        self.min_summary_tokens = min_summary_tokens
+        self.max_chunks = max_chunks
+        self.safety_margin = safety_margin
+
+    def context_tokens(self, prompt: str, answer_system_prompt: str, history: list = None) -> int:
+        # Tokens left for search data in the final request after the prompt, any earlier turns and the reply
+        overhead = count_message_tokens([
+            {'role': 'system', 'content': answer_system_prompt},
+            *(history or []),
+            {'role': 'user', 'content': prompt},
+        ], self.answer_model)
+        window = CONTEXT_WINDOWS.get(self.answer_model, 4096)
+        return max(window - self.answer_max_tokens - overhead - self.safety_margin, 0)
+
+    def chunk_tokens(self, summary_system_prompt: str, summary_tokens: int) -> int:
+        # Largest chunk that still fits the summarizer's window next to its prompt and reply
+        overhead = count_message_tokens([{'role': 'system', 'content': summary_system_prompt}], self.summary_model)
+        window = CONTEXT_WINDOWS.get(self.summary_model, 4096)
+        available = window - summary_tokens - overhead - TOKENS_PER_MESSAGE - self.safety_margin
+        return max(min(self.max_chunk_tokens, available), 1)
+
+    def allocate(self, source_chunk_counts: list, total: int) -> list:
+        # Share the chunk budget fairly, one chunk per source per round, so no single page crowds out the rest
+        allocation = [0] * len(source_chunk_counts)
+        remaining = total
+        while remaining > 0:
+            progressed = False
+            for i, available in enumerate(source_chunk_counts):
+                if remaining > 0 and allocation[i] < available:
+                    allocation[i] += 1
+                    remaining -= 1
+                    progressed = True
+            if not progressed:
+                break
+        return allocation
+
+    def plan(self, prompt: str, sources: list, answer_system_prompt: str, summary_system_prompt: str,
+             query: str = None, history: list = None) -> BudgetPlan:
+        context_tokens = self.context_tokens(prompt, answer_system_prompt, history)
+
+        # Cap the fan-out by the request limit and by how many useful summaries fit in the answer context
+        max_chunks = min(self.max_chunks, context_tokens // self.min_summary_tokens)
+        if max_chunks <= 0:
+            return BudgetPlan([], 0, 0, context_tokens, [0] * len(sources))
+
+        # Size chunks for the worst case summary length, then split every source
+        chunk_tokens = self.chunk_tokens(summary_system_prompt, min(self.summary_max_tokens, context_tokens))
+        source_chunks = [split_tokens(source, chunk_tokens, self.summary_model) for source in sources]
+
+        # With a query, keep the chunks most relevant to it across all sources, best first
+        ranked = rank_chunks(source_chunks, query, max_chunks) if query else []
+        if ranked:
+            chunks = [source_chunks[source][position] for source, position in ranked]
+            allocation = [0] * len(sources)
+            for source, _ in ranked:
+                allocation[source] += 1
+        else:
+            allocation = self.allocate([len(chunks) for chunks in source_chunks], max_chunks)
+
+            # Keep the leading chunks of each source, interleaved so truncation later drops the least important
+            chunks = []
+            for depth in range(max(allocation, default=0)):
+                for i, chunks_for_source in enumerate(source_chunks):
+                    if depth < allocation[i]:
+                        chunks.append(chunks_for_source[depth])
+
+        # Split the answer context evenly between the summaries that will actually be produced
+        summary_tokens = min(self.summary_max_tokens, context_tokens // max(len(chunks), 1))
+        return BudgetPlan(chunks, chunk_tokens, summary_tokens, context_tokens, allocation)
+
+    def plan_stream(self, prompt: str, source_count: int, answer_system_prompt: str, summary_system_prompt: str,
+                    history: list = None) -> BudgetPlan:
+        # Plan before any page has arrived: the same caps, with an even per-source quota instead of exact allocation
+        context_tokens = self.context_tokens(prompt, answer_system_prompt, history)
+        max_chunks = min(self.max_chunks, context_tokens // self.min_summary_tokens)
+        if max_chunks <= 0 or source_count <= 0:
+            return BudgetPlan([], 0, 0, context_tokens, [0] * source_count, 0)
+
+        summary_tokens = min(self.summary_max_tokens, context_tokens // max_chunks)
+        chunk_tokens = self.chunk_tokens(summary_system_prompt, summary_tokens)
+        per_source = math.ceil(max_chunks / source_count)
+        return BudgetPlan([], chunk_tokens, summary_tokens, context_tokens, [per_source] * source_count, max_chunks)
@@ -0,0 +1,231 @@
+import contextvars
+import json
+import threading
+import time
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+
+# USD per 1,000 prompt and completion tokens, used to estimate what a question cost
+MODEL_PRICES = {
+    'gpt-3.5-turbo': (0.0015, 0.002),
+    'gpt-3.5-turbo-16k': (0.003, 0.004),
+    'gpt-4': (0.03, 0.06),
+}
+
+# The trace of the question being answered, inherited by every task the pipeline starts
+current_trace = contextvars.ContextVar('current_trace', default=None)
+# The innermost open span, so new spans know their parent
+current_span = contextvars.ContextVar('current_span', default=None)
+
+def reset_variable(variable: contextvars.ContextVar, token: contextvars.Token):
+    # An abandoned answer stream may be closed by the event loop from another context, where the token does not apply
+    try:
+        variable.reset(token)
+    except ValueError:
+        pass
+
+def estimate_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    prompt_price, completion_price = MODEL_PRICES.get(model, MODEL_PRICES['gpt-3.5-turbo'])
+    return (prompt_tokens * prompt_price + completion_tokens * completion_price) / 1000
+
+# One timed step of a question, such as a search, a page download or a completion
+class Span:
+    def __init__(self, name: str, parent: 'Span' = None, **attributes):
+        self.name = name
+        self.parent = parent
+        self.attributes = attributes
+        self.start = time.perf_counter()
+        self.end = None
+        self.error = None
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def to_dict(self, origin: float) -> dict:
+        return {
+            'name': self.name,
+            'parent': self.parent.name if self.parent is not None else None,
+            'start': round(self.start - origin, 6),
+            'duration': round(self.duration, 6),
+            'error': self.error,
+            **self.attributes,
+        }
+
+# Everything measured while answering one question
+class Trace:
+    def __init__(self, name: str = 'question', **attributes):
+        self.name = name
+        self.attributes = attributes
+        self.started = time.perf_counter()
+        self.finished = None
+        self.spans = []
+        self.bytes_by_url = Counter()
+        self.usage = defaultdict(Counter)
+        self.retries = Counter()
+        self.cache_hits = Counter()
+        self.cache_misses = Counter()
+        self.counters = Counter()
+
+    @contextmanager
+    def span(self, name: str, **attributes):
+        span = Span(name, current_span.get(), **attributes)
+        self.spans.append(span)
+        token = current_span.set(span)
+        try:
+            yield span
+        except BaseException as error:
+            span.error = type(error).__name__
+            raise
+        finally:
+            span.end = time.perf_counter()
+            reset_variable(current_span, token)
+
+    def finish(self):
+        if self.finished is None:
+            self.finished = time.perf_counter()
+
+    @property
+    def duration(self) -> float:
+        return (self.finished if self.finished is not None else time.perf_counter()) - self.started
+
+    @property
+    def cost(self) -> float:
+        return sum(estimate_cost(model, usage['prompt_tokens'], usage['completion_tokens']) for model, usage in self.usage.items())
+
+    def stage_durations(self) -> dict:
+        # Total time per span name; spans of the same name may overlap, so these can exceed the duration
+        durations = defaultdict(float)
+        for span in self.spans:
+            durations[span.name] += span.duration
+        return dict(durations)
+
+    def to_dict(self) -> dict:
+        return {
+            'name': self.name,
+            **self.attributes,
+            'duration': round(self.duration, 6),
+            'spans': [span.to_dict(self.started) for span in self.spans],
+            'bytes_by_url': dict(self.bytes_by_url),
+            'usage': {model: dict(usage) for model, usage in self.usage.items()},
+            'retries': dict(self.retries),
+            'cache_hits': dict(self.cache_hits),
+            'cache_misses': dict(self.cache_misses),
+            'counters': dict(self.counters),
+            'cost': round(self.cost, 6),
+        }
+
+@contextmanager
+def trace_context(trace: Trace):
+    # Make trace the current trace for the code inside the block and the tasks it starts
+    token = current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        reset_variable(current_trace, token)
+
+@contextmanager
+def span(name: str, **attributes):
+    # Time a step in the current trace; outside of a trace this does nothing
+    trace = current_trace.get()
+    if trace is None:
+        yield None
+        return
+    with trace.span(name, **attributes) as opened:
+        yield opened
+
+def record_bytes(url: str, size: int):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.bytes_by_url[url] += size
+
+def record_usage(model: str, usage: dict):
+    trace = current_trace.get()
+    if trace is not None and usage:
+        for key in ('prompt_tokens', 'completion_tokens', 'total_tokens'):
+            trace.usage[model][key] += usage.get(key, 0)
+
+def record_retry(model: str):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.retries[model] += 1
+
+def record_cache(cache: str, hit: bool):
+    trace = current_trace.get()
+    if trace is not None:
+        (trace.cache_hits if hit else trace.cache_misses)[cache] += 1
+
+def record_count(name: str, value: int = 1):
+    trace = current_trace.get()
+    if trace is not None:
+        trace.counters[name] += value
+
+# Running totals over finished traces, for a local exporter or a health endpoint
+class MetricsRegistry:
+    def __init__(self, max_samples: int = 1000):
+        # Only the most recent durations are kept per stage, enough for stable percentiles
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self.questions = 0
+        self.errors = 0
+        self.bytes = 0
+        self.cost = 0.0
+        self.tokens = Counter()
+        self.retries = Counter()
+        self.cache_hits = Counter()
+        self.cache_misses = Counter()
+        self.counters = Counter()
+        self.durations = defaultdict(list)
+
+    def record(self, trace: Trace, error: BaseException = None):
+        with self._lock:
+            self.questions += 1
+            self.errors += error is not None
+            self.bytes += sum(trace.bytes_by_url.values())
+            self.cost += trace.cost
+            for usage in trace.usage.values():
+                self.tokens.update(usage)
+            self.retries.update(trace.retries)
+            self.cache_hits.update(trace.cache_hits)
+            self.cache_misses.update(trace.cache_misses)
+            self.counters.update(trace.counters)
+            for name, duration in dict(trace.stage_durations(), **{trace.name: trace.duration}).items():
+                samples = self.durations[name]
+                samples.append(duration)
+                del samples[:-self.max_samples]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            stages = {}
+            for name, samples in self.durations.items():
+                ordered = sorted(samples)
+                stages[name] = {
+                    'count': len(ordered),
+                    'p50': ordered[int(0.50 * (len(ordered) - 1))],
+                    'p95': ordered[int(0.95 * (len(ordered) - 1))],
+                    'max': ordered[-1],
+                }
+            return {
+                'questions': self.questions,
+                'errors': self.errors,
+                'bytes': self.bytes,
+                'cost': round(self.cost, 6),
+                'tokens': dict(self.tokens),
+                'retries': dict(self.retries),
+                'cache_hits': dict(self.cache_hits),
+                'cache_misses': dict(self.cache_misses),
+                'counters': dict(self.counters),
+                'stages': stages,
+            }
+
+# Appends each finished trace as one JSON line to a local file
+class JsonLinesExporter:
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace):
+        line = json.dumps(trace.to_dict())
+        with self._lock:
+            with open(self.path, 'a', encoding='utf-8') as file:
+                file.write(line + '\n')
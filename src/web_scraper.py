@@ -1,49 +1,323 @@
 import aiohttp
 import asyncio
-from bs4 import BeautifulSoup
 import re
 from exceptions import HttpsError
-import chardet
+from http_client import HttpClient
+from html_text import HtmlTextExtractor, extract_text_from_bytes, extract_text_with_soup
+from parse_executor import ParseExecutor
+from charset import resolve_encoding, lookup_encoding, DETECT_SAMPLE_SIZE
+from disk_cache import DiskCache
+from single_flight import SingleFlight
+from tracing import span, record_bytes, record_cache, record_count
+from domain_health import DomainHealth, domain_of
+import codecs
+import time
 
 # Set a timeout for all HTTP requests
 timeout = aiohttp.ClientTimeout(total=3)
 
-async def extract_text_from_website(url: str, session) -> str:
+# Limits that keep memory per fetch bounded when streaming a page
+MAX_PAGE_BYTES = 2 * 1024 * 1024
+MAX_PAGE_CHARS = 200000
+
+# Bytes read from the socket per step, and bytes gathered to resolve an undeclared encoding
+READ_CHUNK_SIZE = 64 * 1024
+SNIFF_SIZE = 4096
+
+# Content types worth parsing for text
+HTML_CONTENT_TYPES = ('text/html', 'application/xhtml+xml')
+
+def get_incremental_decoder(encoding: str):
+    try:
+        return codecs.getincrementaldecoder(encoding)(errors='replace')
+    except (LookupError, TypeError):
+        return codecs.getincrementaldecoder('utf-8')(errors='replace')
+
+# Parses on the event loop unless a pooled executor is supplied
+inline_executor = ParseExecutor('inline')
+
+async def extract_text_from_website(url: str, session, streaming: bool = True,
+                                    max_bytes: int = MAX_PAGE_BYTES, max_chars: int = MAX_PAGE_CHARS,
+                                    parse_executor: ParseExecutor = inline_executor) -> str:
     try:
         # Make an asynchronous GET request to the URL
         async with session.get(url, timeout=timeout) as response:
             if response.status == 200:
-                # Read raw response and detect encoding
-                raw = await response.read()
-                encoding = chardet.detect(raw)['encoding']
-                # Decode response using detected encoding
-                text = raw.decode(encoding)
-                # Parse the HTML and extract text
-                soup = BeautifulSoup(text, 'lxml')
-                page_text = soup.get_text()
-                page_text.strip()
-                return page_text
+                return await extract_text_from_response(response, streaming, max_bytes, max_chars, parse_executor)
             else:
                 return ''
     except Exception as error:
         print(error)
         return ''
 
-async def extract_text_from_websites(urls: list):
-    websites_text = ''
+async def extract_text_from_response(response, streaming: bool = True,
+                                     max_bytes: int = MAX_PAGE_BYTES, max_chars: int = MAX_PAGE_CHARS,
+                                     parse_executor: ParseExecutor = inline_executor) -> str:
+    if not streaming:
+        # Read raw response and resolve its encoding from the header, BOM, meta tag or a sample
+        raw = await response.read()
+        record_bytes(str(response.url), len(raw))
+        encoding, _ = resolve_encoding(response.charset, raw[:DETECT_SAMPLE_SIZE])
+        # Parse the HTML and extract text on the configured executor
+        return await parse_executor.run(extract_text_with_soup, raw, encoding)
+
+    # Skip documents such as PDFs or images without downloading them
+    if 'Content-Type' in response.headers and response.content_type not in HTML_CONTENT_TYPES:
+        return ''
 
-    # Create a ClientSession for making HTTP requests
-    async with aiohttp.ClientSession() as session:
-        # Extract text from each website concurrently
-        results = await asyncio.gather(*(extract_text_from_website(url, session) for url in urls))
+    # A pooled executor gets the capped raw bytes and returns only the extracted text
+    if not parse_executor.inline:
+        raw = await read_capped(response, max_bytes)
+        record_bytes(str(response.url), len(raw))
+        encoding, _ = resolve_encoding(response.charset, raw[:DETECT_SAMPLE_SIZE])
+        return await parse_executor.run(extract_text_from_bytes, raw, encoding, max_chars)
 
-        # Concatenate text from all websites
-        for result in results:
-             if result:
-                websites_text += result
+    return await stream_text_from_response(response, max_bytes, max_chars)
+
+async def stream_text_from_response(response, max_bytes: int = MAX_PAGE_BYTES, max_chars: int = MAX_PAGE_CHARS) -> str:
+    extractor = HtmlTextExtractor(max_chars)
+    # A valid charset in the header means there is no need to sniff the body
+    header_encoding = lookup_encoding(response.charset)
+    decoder = None
+    pending = b''
+    received = 0
+
+    # Read the body piece by piece and parse as it arrives, stopping at the byte or character cap
+    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+        chunk = chunk[:max_bytes - received]
+        received += len(chunk)
+        if decoder is None:
+            # Without a declared charset, gather a small sample for the BOM, meta tag or detection
+            pending += chunk
+            if not header_encoding and len(pending) < SNIFF_SIZE and received < max_bytes:
+                continue
+            decoder = get_incremental_decoder(resolve_encoding(response.charset, pending)[0])
+            chunk, pending = pending, b''
+        if extractor.feed(decoder.decode(chunk)) or received >= max_bytes:
+            break
+
+    record_bytes(str(response.url), received)
+
+    # Flush whatever is left in the sample and the decoder
+    if decoder is None:
+        decoder = get_incremental_decoder(resolve_encoding(response.charset, pending)[0])
+    extractor.feed(decoder.decode(pending, final=True))
+    return extractor.close()
+
+async def read_capped(response, max_bytes: int = MAX_PAGE_BYTES) -> bytes:
+    # Read the body in chunks, stopping once the byte cap is reached
+    body = bytearray()
+    async for chunk in response.content.iter_chunked(READ_CHUNK_SIZE):
+        body += chunk[:max_bytes - len(body)]
+        if len(body) >= max_bytes:
+            break
+    return bytes(body)
+
+# A class for scraping the visible text of websites over a shared HTTP transport
+class WebScraper:
+    # How long a cached page is served without asking the origin again
+    PAGE_MAX_AGE = 10 * 60
+
+    def __init__(self, http_client: HttpClient = None, streaming: bool = True,
+                 max_page_bytes: int = MAX_PAGE_BYTES, max_page_chars: int = MAX_PAGE_CHARS,
+                 parse_executor: ParseExecutor = None, page_cache: DiskCache = None,
+                 page_max_age: float = PAGE_MAX_AGE, domain_health: DomainHealth = None, hedging: bool = True):
+        self.http_client = http_client if http_client is not None else HttpClient()
+        # Whether pages are parsed incrementally while downloading, and the per-page caps that apply
+        self.streaming = streaming
+        self.max_page_bytes = max_page_bytes
+        self.max_page_chars = max_page_chars
+        # Where HTML parsing runs: inline on the loop, or on a thread or process pool
+        self.parse_executor = parse_executor if parse_executor is not None else inline_executor
+        # Optional persistent cache of extracted text with the validators needed to revalidate it
+        self.page_cache = page_cache
+        self.page_max_age = page_max_age
+        self.revalidations = 0
+        # Concurrent requests for the same URL share one download
+        self.single_flight = SingleFlight()
+        # Latency and failures of every site, setting its timeout and concurrency and skipping sites that keep failing
+        self.domain_health = domain_health if domain_health is not None else DomainHealth()
+        # Whether a slow page makes iter_texts_from_websites start one of the spare links as well
+        self.hedging = hedging
+
+    async def extract_text_from_website(self, url: str, session, bypass_cache: bool = False) -> str:
+        with span('fetch', url=url):
+            return await self.single_flight.run((url, bypass_cache), lambda: self.fetch_text(url, session, bypass_cache))
 
-    # Raise an error if no text was extracted
-    if not websites_text:
-        raise HttpsError('Failed to extract text from the provided URLs.')
+    async def fetch_text(self, url: str, session, bypass_cache: bool = False) -> str:
+        cached = None if bypass_cache or self.page_cache is None else self.page_cache.get_entry(url)
+        headers = {}
+        if cached is not None:
+            page, stored_at = cached
+            # A fresh page costs no request at all
+            if time.time() - stored_at < self.page_max_age:
+                record_cache('pages', True)
+                return page['text']
+            # A stale page is revalidated with a conditional request
+            if page.get('etag'):
+                headers['If-None-Match'] = page['etag']
+            if page.get('last_modified'):
+                headers['If-Modified-Since'] = page['last_modified']
+
+        # Sites that failed several times in a row are not tried again until their skip period is over
+        domain = domain_of(url)
+        health = self.domain_health
+        if health.is_skipped(domain):
+            record_count('fetch_skipped')
+            return ''
+
+        async with health.limiter(domain):
+            # The timer starts once a slot is free, so waiting on the site's other downloads is not held against it
+            started = time.perf_counter()
+            try:
+                request_timeout = aiohttp.ClientTimeout(total=health.timeout_for(domain))
+                async with session.get(url, headers=headers, timeout=request_timeout) as response:
+                    if response.status == 304 and cached is not None:
+                        # Unchanged on the origin, so the stored text is served without downloading or parsing
+                        health.record_success(domain, time.perf_counter() - started)
+                        self.page_cache.touch(url)
+                        self.revalidations += 1
+                        record_cache('pages_revalidated', True)
+                        return cached[0]['text']
+                    if self.page_cache is not None:
+                        record_cache('pages', False)
+                    if response.status != 200:
+                        health.record_failure(domain)
+                        return ''
+
+                    text = await extract_text_from_response(response, self.streaming, self.max_page_bytes,
+                                                            self.max_page_chars, self.parse_executor)
+                    health.record_success(domain, time.perf_counter() - started)
+                    if text and self.page_cache is not None and 'no-store' not in response.headers.get('Cache-Control', ''):
+                        self.page_cache.set(url, {
+                            'text': text,
+                            'etag': response.headers.get('ETag'),
+                            'last_modified': response.headers.get('Last-Modified'),
+                        })
+                    return text
+            except asyncio.TimeoutError:
+                health.record_failure(domain, timed_out=True)
+                record_count('fetch_timeouts')
+                print(f'Timed out fetching {url}')
+                return ''
+            except Exception as error:
+                health.record_failure(domain)
+                print(error)
+                return ''
+
+    async def is_unchanged(self, url: str) -> bool:
+        # Ask the origin with the stored validators whether a cached page is still current; a page that cannot be
+        # checked this way, or whose site does not answer in time, counts as changed
+        cached = self.page_cache.get_entry(url) if self.page_cache is not None else None
+        if cached is None:
+            return False
+        page = cached[0]
+        headers = {}
+        if page.get('etag'):
+            headers['If-None-Match'] = page['etag']
+        if page.get('last_modified'):
+            headers['If-Modified-Since'] = page['last_modified']
+        domain = domain_of(url)
+        if not headers or self.domain_health.is_skipped(domain):
+            return False
+        session = await self.http_client.get_session()
+        try:
+            request_timeout = aiohttp.ClientTimeout(total=self.domain_health.timeout_for(domain))
+            async with session.get(url, headers=headers, timeout=request_timeout) as response:
+                # Only the status is needed; a changed page's body is not downloaded
+                return response.status == 304
+        except Exception:
+            return False
+
+    async def extract_texts_from_websites(self, urls: list, bypass_cache: bool = False) -> list:
+        # Extract text from each website concurrently over the pooled session
+        session = await self.http_client.get_session()
+        results = await asyncio.gather(*(self.extract_text_from_website(url, session, bypass_cache) for url in urls))
+
+        # Keep the text of every website that returned some, one entry per source
+        websites_texts = [result for result in results if result]
+
+        # Raise an error if no text was extracted
+        if not websites_texts:
+            raise HttpsError('Failed to extract text from the provided URLs.')
+
+        return websites_texts
+
+    async def iter_texts_from_websites(self, urls: list, bypass_cache: bool = False, deadline: float = None,
+                                       sources: int = None):
+        """
+        Yields (url, text) for each website as soon as it is done, stopping at the loop-time deadline.
+
+        Args:
+            urls (list): Links in order of preference.
+            bypass_cache (bool): Whether cached pages are ignored.
+            deadline (float): Loop time after which websites still loading are abandoned.
+            sources (int): Pages wanted. As many links are fetched right away; the rest are spares, started when a
+                page fails, is skipped or, with hedging on, runs past its site's usual time. Pages still loading
+                once this many have arrived are abandoned. All links are fetched when omitted.
+        """
+        loop = asyncio.get_running_loop()
+        session = await self.http_client.get_session()
+        spares = list(urls[sources:]) if sources is not None else []
+        tasks = {}
+        # Loop times at which a page still loading gets a spare started alongside it, and the pages that got one
+        hedge_times = {}
+        hedged = set()
+
+        def start(url: str, hedgeable: bool):
+            task = asyncio.create_task(self.extract_text_from_website(url, session, bypass_cache))
+            tasks[task] = url
+            if hedgeable and self.hedging and spares:
+                hedge_times[task] = loop.time() + self.domain_health.hedge_delay_for(domain_of(url))
+
+        def start_spare() -> bool:
+            # Spares are never hedged themselves, so one slow site cannot use up every spare
+            if not spares:
+                return False
+            start(spares.pop(0), False)
+            return True
+
+        for url in (urls[:sources] if sources is not None else urls):
+            start(url, True)
+        pending = set(tasks)
+        delivered = 0
+        try:
+            while pending and (sources is None or delivered < sources):
+                wake_times = [hedge_times[task] for task in pending if task in hedge_times]
+                if deadline is not None:
+                    wake_times.append(deadline)
+                wait_time = max(min(wake_times) - loop.time(), 0) if wake_times else None
+                done, pending = await asyncio.wait(pending, timeout=wait_time, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    hedge_times.pop(task, None)
+                    if task.result():
+                        delivered += 1
+                        yield tasks[task], task.result()
+                    elif task not in hedged:
+                        # A page that failed or was skipped is replaced by the next spare
+                        start_spare()
+                if deadline is not None and loop.time() >= deadline:
+                    break
+                # Pages running past their site's usual time get a spare racing them; the slow page is kept
+                now = loop.time()
+                for task in [task for task, due in hedge_times.items() if due <= now]:
+                    del hedge_times[task]
+                    hedged.add(task)
+                    if start_spare():
+                        record_count('fetch_hedged')
+                pending = {task for task in tasks if not task.done()}
+        finally:
+            # Slow websites still loading at the deadline, or when the caller stops early, are abandoned
+            for task in tasks:
+                task.cancel()
+
+    async def extract_text_from_websites(self, urls: list, bypass_cache: bool = False) -> str:
+        # Concatenate text from all websites
+        return ''.join(await self.extract_texts_from_websites(urls, bypass_cache))
 
-    return websites_text
\ No newline at end of file
+async def extract_text_from_websites(urls: list, http_client: HttpClient = None):
+    # Use the given transport, or a temporary one that is closed afterwards
+    if http_client is not None:
+        return await WebScraper(http_client).extract_text_from_websites(urls)
+    async with HttpClient() as client:
+        return await WebScraper(client).extract_text_from_websites(urls)